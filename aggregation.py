@@ -0,0 +1,309 @@
+from collections import Counter
+from functools import lru_cache
+from math import floor, log
+from operator import itemgetter
+from sketches import TopK, HyperLogLog, TOP_K_ERROR, DISTINCT_ERROR
+
+ROW_FIELD_NAMES = ("server_name", "timestamp", "elapsed", "client_ip", "status_code", "bytes", "method", "url",
+                   "rfc931", "how", "type")
+HISTOGRAM_BASE = 1.05           # Bucket width of histograms; percentiles are accurate to about half of this
+PERCENTILES = (50, 95, 99)
+
+
+@lru_cache(maxsize=65536)
+def get_host(url: str) -> str:
+
+    """
+    Given a URL from the log, return the host and port the request went to
+    """
+    if url:
+        if url.startswith("http:"):
+            # Remove full URL from HTTP requests
+            host = url[7:].split('/')[0]
+            host = host if ":" in host else f"{host}:80"
+        else:
+            host = url
+    else:
+        host = "unknownhost.unknowndomain"
+    return host
+
+
+@lru_cache(maxsize=1024)
+def get_how(how: str) -> str:
+
+    return how.split("/")[0]
+
+
+@lru_cache(maxsize=1024)
+def get_status_class(status_code: str) -> str:
+
+    """
+    Given a status code from the log, such as TCP_MISS/503, return the class of its HTTP status, such as "5xx"
+    """
+    code = status_code.rpartition("/")[2]
+    return f"{code[0]}xx" if len(code) == 3 and code.isdigit() else ""
+
+
+AGGREGATIONS = {
+    # Name: (field to group by, function deriving the group from the field, field to sum or None to count requests)
+    'requests_by_server': ('server_name', None, None),
+    'requests_by_client_ip': ('client_ip', None, None),
+    'requests_by_method': ('method', None, None),
+    'requests_by_domain': ('url', get_host, None),
+    'requests_by_status_code': ('status_code', None, None),
+    'requests_by_how': ('how', get_how, None),
+    'bytes_by_server': ('server_name', None, 'bytes'),
+    'bytes_by_client_ip': ('client_ip', None, 'bytes'),
+    'bytes_by_domain': ('url', get_host, 'bytes'),
+}
+HISTOGRAMS = {
+    # Name: (field to group by, field whose distribution is summarized as percentiles)
+    'elapsed_by_status_code': ('status_code', 'elapsed'),
+}
+# Aggregations with too many keys to return in full, which keep only the top K when approximating
+APPROXIMATE_AGGREGATIONS = ('requests_by_client_ip', 'requests_by_domain', 'bytes_by_client_ip', 'bytes_by_domain')
+DISTINCT_COUNTS = {
+    # Name: (field, function deriving the key from the field).  Only estimated when approximating
+    'distinct_client_ips': ('client_ip', None),
+    'distinct_domains': ('url', get_host),
+}
+
+
+def get_bucket(value: float) -> int:
+
+    return round(log(value, HISTOGRAM_BASE)) if value > 0 else -1
+
+
+def get_percentiles(histogram: Counter, percentiles: tuple = PERCENTILES) -> dict:
+
+    """
+    Given a histogram of bucket -> count, estimate the value at each percentile
+    """
+    total = sum(histogram.values())
+    values = {}
+    seen = 0
+    buckets = iter(sorted(histogram.items()))
+    for percentile in percentiles:
+        while seen < total * percentile / 100:
+            bucket, count = next(buckets)
+            seen += count
+            value = round(HISTOGRAM_BASE ** bucket) if bucket >= 0 else 0
+        values[f"p{percentile}"] = value if total else None
+    return values
+
+
+class Aggregator:
+
+    """
+    Computes every group-by count, sum and histogram in a single pass over parsed rows.  Aggregators built from
+    different servers or worker processes can be merged.  With top_k, the high cardinality aggregations keep
+    approximate counts of their top K keys in bounded memory, and distinct keys are estimated
+    """
+
+    def __init__(self, aggregations: dict = None, histograms: dict = None, top_k: int = None,
+                 top_k_error: float = TOP_K_ERROR, distinct_error: float = DISTINCT_ERROR):
+
+        self.aggregations = AGGREGATIONS if aggregations is None else aggregations
+        self.histograms = HISTOGRAMS if histograms is None else histograms
+        self.options = (top_k, top_k_error, distinct_error)
+        self.totals = {name: TopK(top_k, top_k_error) if top_k and name in APPROXIMATE_AGGREGATIONS else Counter()
+                       for name in self.aggregations}
+        self.distributions = {name: {} for name in self.histograms}
+        self.distinct = {name: HyperLogLog(distinct_error) for name in DISTINCT_COUNTS} if top_k else {}
+        self._plan = tuple(
+            (self.totals[name], ROW_FIELD_NAMES.index(field), function,
+             ROW_FIELD_NAMES.index(value_field) if value_field else None)
+            for name, (field, function, value_field) in self.aggregations.items()
+        )
+        self._histogram_plan = tuple(
+            (self.distributions[name], ROW_FIELD_NAMES.index(field), ROW_FIELD_NAMES.index(value_field))
+            for name, (field, value_field) in self.histograms.items()
+        )
+        self._distinct_plan = tuple(
+            (self.distinct[name], ROW_FIELD_NAMES.index(field), function)
+            for name, (field, function) in DISTINCT_COUNTS.items() if name in self.distinct
+        )
+
+    def __getstate__(self) -> tuple:
+
+        return self.aggregations, self.histograms, self.options, self.totals, self.distributions, self.distinct
+
+    def __setstate__(self, state: tuple):
+
+        aggregations, histograms, options, totals, distributions, distinct = state
+        self.__init__(aggregations, histograms, *options)
+        for name, counter in totals.items():
+            self.totals[name].update(counter)
+        for name, distribution in distributions.items():
+            self.distributions[name].update(distribution)
+        for name, sketch in distinct.items():
+            self.distinct[name].update(sketch)
+
+    def add(self, row: tuple):
+
+        """
+        Count a row whose values are in the order of ROW_FIELD_NAMES
+        """
+        for counter, index, function, value_index in self._plan:
+            key = function(row[index]) if function else row[index]
+            counter[key] += 1 if value_index is None else row[value_index]
+        for distribution, index, value_index in self._histogram_plan:
+            if (histogram := distribution.get(row[index])) is None:
+                histogram = distribution[row[index]] = Counter()
+            histogram[get_bucket(row[value_index])] += 1
+        for sketch, index, function in self._distinct_plan:
+            sketch.add(function(row[index]) if function else row[index])
+
+    def add_keys(self, field: str, keys: list):
+
+        """
+        Make sure the given keys show up in every aggregation grouped by the field, even with no rows
+        """
+        for name, (_field, function, _) in self.aggregations.items():
+            if _field == field:
+                for key in keys:
+                    self.totals[name][function(key) if function else key] += 0
+
+    def merge(self, other: "Aggregator") -> "Aggregator":
+
+        for name, counter in other.totals.items():
+            self.totals[name].update(counter)
+        for name, distribution in other.distributions.items():
+            for key, histogram in distribution.items():
+                self.distributions[name].setdefault(key, Counter()).update(histogram)
+        for name, sketch in self.distinct.items():
+            if name in other.distinct:
+                sketch.update(other.distinct[name])
+                continue
+            # An exact aggregator has every key of the aggregations grouped the same way, so count those instead
+            for _name, (field, function, _) in other.aggregations.items():
+                if (field, function) == DISTINCT_COUNTS[name] and isinstance(other.totals[_name], Counter):
+                    for key in other.totals[_name]:
+                        sketch.add(key)
+                    break
+        return self
+
+    def items(self):
+
+        """
+        Yield every value held as a (name, key, bucket, value) tuple.  Only histograms use the bucket, the others
+        leave it at 0
+        """
+        for name, counter in self.totals.items():
+            for key, value in counter.items():
+                yield name, key, 0, value
+        for name, distribution in self.distributions.items():
+            for key, histogram in distribution.items():
+                for bucket, count in histogram.items():
+                    yield name, key, bucket, count
+
+    def add_items(self, items):
+
+        """
+        Add values in the form yielded by items(), such as ones read back from storage
+        """
+        for name, key, bucket, value in items:
+            if name in self.totals:
+                self.totals[name][key] += value
+            elif name in self.distributions:
+                self.distributions[name].setdefault(key, Counter())[bucket] += value
+
+    def results(self) -> dict:
+
+        """
+        Return each aggregation by name, with histograms summarized as percentiles.  Approximate aggregations
+        return their top K keys, and how much each of their counts may be under by in max_errors
+        """
+        _ = {name: dict(counter.most_common()) if isinstance(counter, TopK) else counter
+             for name, counter in self.totals.items()}
+        for name, distribution in self.distributions.items():
+            _[name] = {key: get_percentiles(histogram) for key, histogram in distribution.items()}
+        for name, sketch in self.distinct.items():
+            _[name] = sketch.count()
+        if max_errors := {name: c.max_error for name, c in self.totals.items() if isinstance(c, TopK)}:
+            _['max_errors'] = max_errors
+        return _
+
+
+class TimeHistogram:
+
+    """
+    Counts requests, bytes and 4xx and 5xx errors, and the distribution of elapsed times, in fixed-width time
+    buckets over a time range, optionally per server or status code.  Like an Aggregator, it's fed parsed rows one
+    at a time, so nothing but the buckets is kept, and histograms from different servers or worker processes can
+    be merged.  Buckets start at multiples of their width, so charts of overlapping time ranges line up
+    """
+
+    def __init__(self, time_range: tuple, bucket_size: int, group_by: str = None):
+
+        self.time_range = tuple(time_range)
+        self.bucket_size = bucket_size
+        self.group_by = group_by
+        self.groups = {}    # group: {bucket start: [requests, bytes, 4xx errors, 5xx errors, elapsed histogram]}
+        self._index = ROW_FIELD_NAMES.index(group_by) if group_by else None
+        self._values = itemgetter(*(ROW_FIELD_NAMES.index(_) for _ in ('timestamp', 'elapsed', 'status_code', 'bytes')))
+
+    def add(self, row: tuple):
+
+        """
+        Count a row whose values are in the order of ROW_FIELD_NAMES
+        """
+        timestamp, elapsed, status_code, size = self._values(row)
+        group = row[self._index] if self._index is not None else "all"
+        if (buckets := self.groups.get(group)) is None:
+            buckets = self.groups[group] = {}
+        start = floor(timestamp / self.bucket_size) * self.bucket_size
+        if (bucket := buckets.get(start)) is None:
+            bucket = buckets[start] = [0, 0, 0, 0, Counter()]
+        bucket[0] += 1
+        bucket[1] += size
+        if (status_class := get_status_class(status_code)) == "4xx":
+            bucket[2] += 1
+        elif status_class == "5xx":
+            bucket[3] += 1
+        bucket[4][get_bucket(elapsed)] += 1
+
+    def add_keys(self, field: str, keys: list):
+
+        """
+        Make sure the given keys show up as groups, even with no rows, if grouping by the field
+        """
+        if field == self.group_by:
+            for key in keys:
+                self.groups.setdefault(key, {})
+
+    def merge(self, other: "TimeHistogram") -> "TimeHistogram":
+
+        for group, buckets in other.groups.items():
+            _ = self.groups.setdefault(group, {})
+            for start, (requests, size, client_errors, server_errors, elapsed) in buckets.items():
+                if (bucket := _.get(start)) is None:
+                    bucket = _[start] = [0, 0, 0, 0, Counter()]
+                bucket[0] += requests
+                bucket[1] += size
+                bucket[2] += client_errors
+                bucket[3] += server_errors
+                bucket[4].update(elapsed)
+        return self
+
+    def results(self) -> dict:
+
+        """
+        Return the start of every bucket in the time range, and for each group, a list per value with an item per
+        bucket.  Empty buckets count zero, with no percentiles
+        """
+        first = floor(self.time_range[0] / self.bucket_size) * self.bucket_size
+        starts = list(range(first, self.time_range[1], self.bucket_size))
+        empty = [0, 0, 0, 0, Counter()]
+        series = {}
+        for group, buckets in sorted(self.groups.items()):
+            values = [buckets.get(start, empty) for start in starts]
+            percentiles = [get_percentiles(bucket[4]) for bucket in values]
+            series[group] = {
+                'requests': [bucket[0] for bucket in values],
+                'bytes': [bucket[1] for bucket in values],
+                'errors_4xx': [bucket[2] for bucket in values],
+                'errors_5xx': [bucket[3] for bucket in values],
+                **{f"elapsed_{k}": [_[k] for _ in percentiles] for k in (f"p{p}" for p in PERCENTILES)},
+            }
+        return {'bucket_size': self.bucket_size, 'group_by': self.group_by, 'starts': starts, 'series': series}
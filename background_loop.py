@@ -0,0 +1,44 @@
+from asyncio import new_event_loop, run_coroutine_threadsafe, AbstractEventLoop
+from threading import Thread, Lock
+
+_loop = None
+_lock = Lock()
+
+
+def get_background_loop() -> AbstractEventLoop:
+
+    """
+    Return this process's long-running event loop, starting its thread on first use
+    """
+    global _loop
+
+    with _lock:
+        if not _loop:
+            _loop = new_event_loop()
+            Thread(target=_loop.run_forever, name="background_loop", daemon=True).start()
+    return _loop
+
+
+def run_in_background(coroutine, timeout: float = None):
+
+    """
+    Run a coroutine on the background loop from any thread, blocking until its result is ready.  Coroutines
+    from different threads run concurrently, and whatever they leave on the loop (sessions, tokens) is reused
+    """
+    return run_coroutine_threadsafe(coroutine, get_background_loop()).result(timeout)
+
+
+def stop_background_loop(cleanup=None):
+
+    """
+    Run an optional cleanup coroutine function, then stop the background loop
+    """
+    global _loop
+
+    with _lock:
+        loop, _loop = _loop, None
+    if loop:
+        if cleanup:
+            run_coroutine_threadsafe(cleanup(), loop).result(10)
+        loop.call_soon_threadsafe(loop.stop)
+
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmarks.  Writes synthetic Squid logs to a local directory, serves it as a bucket through the local
+storage client, and times parsing, aggregation, merging and get_data() end to end over several window sizes.
+Each benchmark runs in a fresh process, so the peak RSS reported is its own
+
+    python3 bench.py --servers 4 --lines 250000 --windows 900,3600,21600,86400
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os import makedirs, utime
+from os.path import join, getsize
+from random import Random
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from sys import platform
+from tempfile import mkdtemp
+from time import time, perf_counter
+import json
+
+LOCATION = "bench"
+FILE_PATH = "logs/"
+SERVERS = 4
+LINES = 250000                  # Lines written per server
+DURATION = 86400                # Seconds covered by each server's log, ending now
+CLIENT_IPS = 2000
+DOMAINS = 10000
+WINDOWS = (900, 3600, 21600, 86400)
+BENCHMARKS = ("parse", "aggregate", "merge", "get_data")
+STATUS_CODES = ("TCP_MISS/200", "TCP_TUNNEL/200", "TCP_MEM_HIT/200", "TCP_MISS/304", "TCP_DENIED/403",
+                "TCP_MISS/404", "TCP_MISS/503", "NONE/000")
+METHODS = ("GET", "GET", "GET", "CONNECT", "CONNECT", "POST", "HEAD")
+TYPES = ("text/html", "application/json", "image/png", "application/octet-stream", "-")
+
+
+def generate_log(lines: int, end_time: int, duration: int = DURATION, client_ips: int = CLIENT_IPS,
+                 domains: int = DOMAINS, seed: int = 0) -> bytes:
+
+    """
+    Return a log in Squid's native format, with lines spread evenly over the duration up to the end time.  Client
+    IPs and domains are drawn from pools of the given sizes, skewed so a few of them are much busier than the rest
+    """
+    r = Random(seed)
+    ips = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(1, client_ips + 1)]
+    hosts = [f"host{i}.example{i % 97}.com" for i in range(domains)]
+    step = duration / max(lines, 1)
+    timestamp = end_time - duration
+    out = []
+    for i in range(lines):
+        timestamp += step
+        ip = ips[min(int(r.paretovariate(1.2)) - 1, client_ips - 1)]
+        host = hosts[min(int(r.paretovariate(1.1)) - 1, domains - 1)]
+        method = r.choice(METHODS)
+        if method == "CONNECT":
+            url = f"{host}:443"
+        else:
+            url = f"http://{host}/{r.randrange(100000):x}/index.html"
+        out.append(f"{timestamp:.3f} {r.randrange(1, 60000):6d} {ip} {r.choice(STATUS_CODES)} "
+                   f"{r.randrange(200, 2000000)} {method} {url} - HIER_DIRECT/192.0.2.{r.randrange(1, 255)} "
+                   f"{r.choice(TYPES)}")
+    return ("\n".join(out) + "\n").encode()
+
+
+def write_bucket(directory: str, servers: int = SERVERS, lines: int = LINES, end_time: int = None,
+                 duration: int = DURATION, client_ips: int = CLIENT_IPS, domains: int = DOMAINS) -> list:
+
+    """
+    Write a log per server under the directory, dated so each object's updated time is its last line.  Returns
+    the paths written
+    """
+    end_time = end_time or int(time())
+    makedirs(join(directory, FILE_PATH), exist_ok=True)
+    paths = []
+    for i in range(servers):
+        path = join(directory, FILE_PATH, f"proxy{i + 1}.log")
+        with open(path, "wb") as fp:
+            fp.write(generate_log(lines, end_time, duration, client_ips, domains, seed=i))
+        utime(path, (end_time, end_time))
+        paths.append(path)
+    return paths
+
+
+def write_config(directory: str, settings: dict = None) -> tuple:
+
+    """
+    Write settings and locations files that point at the directory as a local bucket.  Returns their paths
+    """
+    settings_file = join(directory, "settings.toml")
+    locations_file = join(directory, "locations.toml")
+    with open(settings_file, "w") as fp:
+        for k, v in (settings or {}).items():
+            fp.write(f"{k} = {json.dumps(v)}\n")
+        fp.write(f"\n[DEFAULT_VALUES]\nlocation = \"{LOCATION}\"\n")
+    with open(locations_file, "w") as fp:
+        fp.write(f"[{LOCATION}]\nbucket_name = {json.dumps(directory)}\nbucket_type = \"local\"\n"
+                 f"file_path = \"{FILE_PATH}\"\n")
+    return settings_file, locations_file
+
+
+def get_peak_rss() -> float:
+
+    """
+    Return the peak resident memory of this process or any of its finished children, in MB
+    """
+    _ = max(getrusage(RUSAGE_SELF).ru_maxrss, getrusage(RUSAGE_CHILDREN).ru_maxrss)
+    return _ / 1048576 if platform == "darwin" else _ / 1024
+
+
+def read_logs(paths: list) -> list:
+
+    blobs = []
+    for path in paths:
+        with open(path, "rb") as fp:
+            blobs.append(fp.read())
+    return blobs
+
+
+def bench_parse(paths: list, time_range: tuple, **kwargs) -> dict:
+
+    """
+    Parse and aggregate each log with process_log(), the work a parse worker does
+    """
+    from main import process_log, find_line_offset, LOG_FIELD_NAMES
+
+    log_fields = dict(enumerate(LOG_FIELD_NAMES))
+    blobs = read_logs(paths)
+    # Rates are of the lines inside the window, as the rest of each log is skipped
+    lines = size = 0
+    for blob in blobs:
+        end = find_line_offset(blob, time_range[1] - 1, lo=(_ := find_line_offset(blob, time_range[0])))
+        lines, size = lines + blob.count(b"\n", _, end), size + end - _
+    start = perf_counter()
+    rows = sum(len(process_log(f"proxy{i + 1}", blob, time_range, log_fields=log_fields)[0])
+               for i, blob in enumerate(blobs))
+    return {'seconds': perf_counter() - start, 'lines': lines, 'rows': rows, 'bytes': size}
+
+
+def bench_aggregate(paths: list, time_range: tuple, top_k: int = None, **kwargs) -> dict:
+
+    """
+    Feed parsed rows through an Aggregator, then merge the per-server aggregators as get_data() does
+    """
+    from main import parse_lines, read_lines_reversed, LOG_FIELD_NAMES
+    from aggregation import Aggregator
+
+    log_fields = dict(enumerate(LOG_FIELD_NAMES))
+    options = {'top_k': top_k} if top_k else {}
+    rows = [list(parse_lines(f"proxy{i + 1}", read_lines_reversed(blob), time_range, log_fields))
+            for i, blob in enumerate(read_logs(paths))]
+    start = perf_counter()
+    aggregators = []
+    for server_rows in rows:
+        aggregator = Aggregator(**options)
+        for row in server_rows:
+            aggregator.add(row)
+        aggregators.append(aggregator)
+    total = Aggregator(**options)
+    for aggregator in aggregators:
+        total.merge(aggregator)
+    total.results()
+    return {'seconds': perf_counter() - start, 'rows': sum(len(_) for _ in rows)}
+
+
+def bench_merge(paths: list, time_range: tuple, limit: int = None, **kwargs) -> dict:
+
+    """
+    Merge the per-server batches into one stream newest first, and format the entries that are kept
+    """
+    from main import process_log, format_entry, LOG_FIELD_NAMES
+    from entry_batch import merge_batches
+
+    log_fields = dict(enumerate(LOG_FIELD_NAMES))
+    batches = [process_log(f"proxy{i + 1}", blob, time_range, log_fields=log_fields, summary=False)[0]
+               for i, blob in enumerate(read_logs(paths))]
+    now = int(time())
+    start = perf_counter()
+    rows = 0
+    for _, batch, i in merge_batches(batches, limit):
+        format_entry(batch.get_entry(i), now)
+        rows += 1
+    return {'seconds': perf_counter() - start, 'rows': rows}
+
+
+def bench_get_data(paths: list, time_range: tuple, directory: str = None, settings: dict = None,
+                   limit: int = None, top_k: int = None, **kwargs) -> dict:
+
+    """
+    Time get_data() end to end against the local bucket, once cold and once more now that it's warmed up
+    """
+    import main
+
+    main.SETTINGS_FILE, main.LOCATIONS_FILE = write_config(directory, settings)
+    env_vars = {'location': LOCATION, 'start_time': str(time_range[0]), 'end_time': str(time_range[1])}
+    if limit is not None:
+        env_vars['limit'] = str(limit)
+    if top_k:
+        env_vars['top_k'] = str(top_k)
+
+    start = perf_counter()
+    data = main.run_get_data(env_vars)
+    seconds = perf_counter() - start
+    start = perf_counter()
+    main.run_get_data(env_vars)
+    warm_seconds = perf_counter() - start
+    return {'seconds': seconds, 'warm_seconds': warm_seconds, 'rows': data['total_entries'] or len(data['entries']),
+            'bytes': data['metrics']['bytes_downloaded'], 'durations': data['durations']}
+
+
+def run_benchmark(name: str, paths: list, time_range: tuple, options: dict) -> dict:
+
+    """
+    Run one benchmark, in what should be a fresh worker process, and add its rates and peak RSS
+    """
+    result = globals()[f"bench_{name}"](paths, time_range, **options)
+    seconds = result['seconds'] or 1e-9
+    if result.get('lines'):
+        result['lines_per_second'] = result['lines'] / seconds
+    result['rows_per_second'] = result['rows'] / seconds
+    if result.get('bytes'):
+        result['mb_per_second'] = result['bytes'] / 1048576 / seconds
+    result['peak_rss_mb'] = get_peak_rss()
+    return result
+
+
+def format_result(name: str, window: int, result: dict) -> str:
+
+    _ = [f"{name:<10} window={window:<6}", f"{result['seconds']:8.3f}s", f"{result['rows']:>9} rows",
+         f"{result['rows_per_second']:>11,.0f} rows/s"]
+    if 'lines_per_second' in result:
+        _.append(f"{result['lines_per_second']:>11,.0f} lines/s")
+    if 'mb_per_second' in result:
+        _.append(f"{result['mb_per_second']:7.1f} MB/s")
+    if 'warm_seconds' in result:
+        _.append(f"warm {result['warm_seconds']:.3f}s")
+    _.append(f"peak {result['peak_rss_mb']:.0f} MB")
+    return "  ".join(_)
+
+
+def main():
+
+    parser = ArgumentParser(description="Benchmark log parsing, aggregation, merging and get_data() offline")
+    parser.add_argument("--servers", type=int, default=SERVERS)
+    parser.add_argument("--lines", type=int, default=LINES, help="lines per server")
+    parser.add_argument("--duration", type=int, default=DURATION, help="seconds covered by each log")
+    parser.add_argument("--client-ips", type=int, default=CLIENT_IPS)
+    parser.add_argument("--domains", type=int, default=DOMAINS)
+    parser.add_argument("--windows", default=",".join(map(str, WINDOWS)), help="window sizes in seconds")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS))
+    parser.add_argument("--limit", type=int, help="entries per page")
+    parser.add_argument("--top-k", type=int, help="approximate client IP and domain counters")
+    parser.add_argument("--setting", action="append", default=[], metavar="NAME=VALUE",
+                        help="setting for get_data(), such as ENTRY_STORE=true or BLOB_CACHE_MAX_BYTES=268435456")
+    parser.add_argument("--directory", help="where to write the logs, instead of a temporary directory")
+    parser.add_argument("--output", help="also write the results to this file as JSON")
+    args = parser.parse_args()
+
+    settings = {}
+    for _ in args.setting:
+        k, v = _.split("=", 1)
+        try:
+            settings[k] = json.loads(v)
+        except ValueError:
+            settings[k] = v
+
+    directory = args.directory or mkdtemp(prefix="squid_bench_")
+    end_time = int(time())
+    start = perf_counter()
+    paths = write_bucket(directory, args.servers, args.lines, end_time, args.duration, args.client_ips,
+                         args.domains)
+    print(f"wrote {args.servers} x {args.lines} lines ({sum(map(getsize, paths)) / 1048576:.1f} MB) to "
+          f"{directory} in {perf_counter() - start:.1f}s")
+
+    options = {'directory': directory, 'settings': settings, 'limit': args.limit, 'top_k': args.top_k}
+    results = []
+    context = get_context("spawn")
+    for window in map(int, args.windows.split(",")):
+        time_range = (end_time - window, end_time + 1)
+        for name in args.benchmarks.split(","):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                result = pool.submit(run_benchmark, name, paths, time_range, options).result()
+            print(format_result(name, window, result))
+            results.append({'benchmark': name, 'window': window, **result})
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump({'servers': args.servers, 'lines': args.lines, 'duration': args.duration,
+                       'client_ips': args.client_ips, 'domains': args.domains, 'settings': settings,
+                       'results': results}, fp, indent=2)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,141 @@
+from os import makedirs, listdir, remove, replace, stat, utime
+from os.path import join, exists, getsize
+from hashlib import sha1
+from tempfile import gettempdir
+from fcntl import flock, LOCK_EX, LOCK_UN
+from mmap import mmap, ACCESS_READ
+import json
+
+CACHE_DIR = join(gettempdir(), "blob_cache")
+MAX_BYTES = 268435456           # Total size of cached blobs before least recently used ones are evicted
+OVERLAP_SIZE = 4096             # Bytes re-read from the end of a cached blob to verify an object has only grown
+
+
+def get_cache_key(bucket: str, object_name: str) -> str:
+
+    return sha1(f"{bucket}/{object_name}".encode()).hexdigest()
+
+
+def get_cache_paths(bucket: str, object_name: str, cache_dir: str = CACHE_DIR) -> tuple:
+
+    """
+    Return the data file, metadata file and lock file paths for an object
+    """
+    key = join(cache_dir, get_cache_key(bucket, object_name))
+    return f"{key}.log", f"{key}.json", f"{key}.lock"
+
+
+def read_blob_meta(bucket: str, object_name: str, cache_dir: str = CACHE_DIR) -> dict:
+
+    """
+    Return what's known about the cached copy of an object: generation, and the object offsets it covers
+    """
+    data_file, meta_file, _ = get_cache_paths(bucket, object_name, cache_dir)
+    try:
+        fp = open(meta_file, mode="rb")
+        meta = json.load(fp)
+        fp.close()
+        # Guard against the data file having been evicted or partially written by another worker
+        if getsize(data_file) != meta['size'] - meta['offset']:
+            return {}
+        return meta
+    except (FileNotFoundError, ValueError, KeyError):
+        return {}
+
+
+def read_blob(bucket: str, object_name: str, start: int = 0, end: int = None, cache_dir: str = CACHE_DIR) -> bytes:
+
+    """
+    Read cached bytes between two positions of the cached copy, marking it as recently used
+    """
+    data_file, _, _ = get_cache_paths(bucket, object_name, cache_dir)
+    fp = open(data_file, mode="rb")
+    fp.seek(start)
+    _ = fp.read() if end is None else fp.read(end - start)
+    fp.close()
+    utime(data_file)
+    return _
+
+
+def map_blob(bucket: str, object_name: str, cache_dir: str = CACHE_DIR) -> mmap:
+
+    """
+    Memory map the cached copy of an object, so it can be searched without reading it all in
+    """
+    data_file, _, _ = get_cache_paths(bucket, object_name, cache_dir)
+    fp = open(data_file, mode="rb")
+    _ = mmap(fp.fileno(), 0, access=ACCESS_READ)
+    fp.close()
+    utime(data_file)
+    return _
+
+
+def write_blob(bucket: str, obj: dict, data: bytes, offset: int = 0, first_timestamp: int = None,
+               append: bool = False, cache_dir: str = CACHE_DIR) -> dict:
+
+    """
+    Store bytes for a GCS object starting at the given object offset, or append them to the cached copy
+    """
+    makedirs(cache_dir, exist_ok=True)
+    data_file, meta_file, lock_file = get_cache_paths(bucket, obj['name'], cache_dir)
+
+    lock = open(lock_file, mode="w")
+    flock(lock, LOCK_EX)
+    try:
+        meta = read_blob_meta(bucket, obj['name'], cache_dir)
+        if append and meta:
+            fp = open(data_file, mode="ab")
+            fp.write(data)
+            fp.close()
+            meta.update({'generation': obj.get('generation'), 'size': meta['size'] + len(data)})
+        else:
+            fp = open(f"{data_file}.tmp", mode="wb")
+            fp.write(data)
+            fp.close()
+            replace(f"{data_file}.tmp", data_file)
+            meta = {
+                'bucket': bucket,
+                'name': obj['name'],
+                'generation': obj.get('generation'),
+                'offset': offset,
+                'size': offset + len(data),
+                'first_timestamp': first_timestamp,
+            }
+        fp = open(f"{meta_file}.tmp", mode="w")
+        json.dump(meta, fp)
+        fp.close()
+        replace(f"{meta_file}.tmp", meta_file)
+    finally:
+        flock(lock, LOCK_UN)
+        lock.close()
+
+    return meta
+
+
+def evict_blobs(max_bytes: int = MAX_BYTES, cache_dir: str = CACHE_DIR) -> int:
+
+    """
+    Remove least recently used blobs until the cache fits in max_bytes.  Return the number of bytes freed
+    """
+    if not exists(cache_dir):
+        return 0
+
+    blobs = []
+    for file_name in listdir(cache_dir):
+        if file_name.endswith(".log"):
+            _ = stat(join(cache_dir, file_name))
+            blobs.append((_.st_mtime, _.st_size, file_name[:-4]))
+
+    total_bytes = sum(size for _, size, _ in blobs)
+    freed = 0
+    for _, size, key in sorted(blobs):
+        if total_bytes - freed <= max_bytes:
+            break
+        for extension in (".log", ".json", ".lock"):
+            try:
+                remove(join(cache_dir, key + extension))
+            except FileNotFoundError:
+                pass
+        freed += size
+
+    return freed
@@ -6,6 +6,7 @@ from random import sample
 from math import floor
 from guppy import hpy
 from main import get_locations, get_data
+from storage_client import close_storage_clients
 from asyncio import run
 
 
@@ -14,6 +15,7 @@ async def main():
     start_time: time = time()
     options = {'location': list(get_locations().keys())[0]}
     data = await get_data(options)
+    await close_storage_clients()
     print("seconds_to_execute:", round((time() - start_time), 3))
     if len(data['entries']) > 0:
         print(f"now: {floor(start_time)}\n first = {data['entries'][0]}\n last = {data['entries'][-1]}")
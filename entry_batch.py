@@ -0,0 +1,201 @@
+from array import array
+from heapq import merge
+from itertools import islice
+from pickle import dump, load, HIGHEST_PROTOCOL
+from spill import SpillFile, SPILL_DIR
+
+NUMERIC_FIELDS = {'timestamp': 'd', 'elapsed': 'q', 'bytes': 'q'}
+STRING_FIELDS = ("client_ip", "status_code", "method", "url", "rfc931", "how", "type")
+SPILL_CHUNK_ROWS = 65536        # Entries a run holds in memory before writing them to its spill file
+
+
+class StringColumn:
+
+    """
+    Dictionary encoded column of strings: each distinct value is stored once, and rows hold its integer code
+    """
+    __slots__ = ('codes', 'values', 'index')
+
+    def __init__(self):
+
+        self.codes = array('I')
+        self.values = []
+        self.index = {}
+
+    def __getstate__(self) -> tuple:
+
+        return self.codes, self.values
+
+    def __setstate__(self, state: tuple):
+
+        self.codes, self.values = state
+        self.index = {v: i for i, v in enumerate(self.values)}
+
+    def __len__(self) -> int:
+
+        return len(self.codes)
+
+    def __getitem__(self, i: int) -> str:
+
+        return self.values[self.codes[i]]
+
+    def append(self, value: str):
+
+        if (code := self.index.get(value)) is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+
+
+class EntryBatch:
+
+    """
+    Parsed log entries for one server, stored as parallel columns rather than a dictionary per line
+    """
+
+    def __init__(self, server_name: str = ""):
+
+        self.server_name = server_name
+        self.timestamp = array(NUMERIC_FIELDS['timestamp'])
+        self.elapsed = array(NUMERIC_FIELDS['elapsed'])
+        self.bytes = array(NUMERIC_FIELDS['bytes'])
+        for field in STRING_FIELDS:
+            setattr(self, field, StringColumn())
+
+    def __len__(self) -> int:
+
+        return len(self.timestamp)
+
+    def append(self, timestamp: float, elapsed: int, client_ip: str, status_code: str, bytes: int, method: str,
+               url: str, rfc931: str, how: str, type: str):
+
+        self.timestamp.append(timestamp)
+        self.elapsed.append(elapsed)
+        self.bytes.append(bytes)
+        self.client_ip.append(client_ip)
+        self.status_code.append(status_code)
+        self.method.append(method)
+        self.url.append(url)
+        self.rfc931.append(rfc931)
+        self.how.append(how)
+        self.type.append(type)
+
+    def get_entry(self, i: int) -> dict:
+
+        """
+        Materialize a single row as a dictionary of raw values
+        """
+        return {
+            'server_name': self.server_name,
+            'timestamp': self.timestamp[i],
+            'elapsed': self.elapsed[i],
+            'client_ip': self.client_ip[i],
+            'status_code': self.status_code[i],
+            'bytes': str(self.bytes[i]),
+            'method': self.method[i],
+            'url': self.url[i],
+            'rfc931': self.rfc931[i],
+            'how': self.how[i],
+            'type': self.type[i],
+        }
+
+    def get_status_codes(self) -> list:
+
+        return self.status_code.values
+
+
+class EntryRun:
+
+    """
+    Parsed log entries for one server that spill to disk to stay within a memory budget.  Entries are appended to
+    a batch in memory, which is pickled to the end of a spill file each time it reaches chunk_rows entries.  Like
+    the batches it's made of, a run is newest first, and reading it back only loads one chunk at a time
+    """
+
+    def __init__(self, server_name: str = "", chunk_rows: int = SPILL_CHUNK_ROWS, directory: str = SPILL_DIR):
+
+        self.server_name = server_name
+        self.chunk_rows = chunk_rows
+        self.directory = directory
+        self.batch = EntryBatch(server_name)
+        self.file = None
+        self.chunks = []                # (file offset, entries) of each spilled chunk, in the order they're read
+        self.status_codes = set()
+        self.spilled_bytes = 0
+
+    def __len__(self) -> int:
+
+        return sum(n for _, n in self.chunks) + len(self.batch)
+
+    def append(self, *row):
+
+        self.batch.append(*row)
+        if len(self.batch) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+
+        """
+        Write the entries held in memory to the spill file
+        """
+        if not len(self.batch):
+            return
+        if self.file is None:
+            self.file = SpillFile(".run", self.directory)
+        self.status_codes.update(self.batch.get_status_codes())
+        with open(self.file.path, "ab") as fp:
+            offset = fp.tell()
+            dump(self.batch, fp, protocol=HIGHEST_PROTOCOL)
+            self.spilled_bytes += fp.tell() - offset
+        self.chunks.append((offset, len(self.batch)))
+        self.batch = EntryBatch(self.server_name)
+
+    def reverse(self):
+
+        """
+        Flip the order chunks are read in, for runs whose chunks were each written newest first but oldest chunk
+        first
+        """
+        if self.chunks:
+            self.flush()
+            self.chunks.reverse()
+
+    def finish(self):
+
+        """
+        Return the run, or just its batch if nothing had to be spilled
+        """
+        return self if self.chunks else self.batch
+
+    def get_status_codes(self) -> list:
+
+        return list(self.status_codes.union(self.batch.get_status_codes()))
+
+    def iter_rows(self):
+
+        if self.chunks:
+            with open(self.file.path, "rb") as fp:
+                for offset, _ in self.chunks:
+                    fp.seek(offset)
+                    yield from iter_rows(load(fp))
+        yield from iter_rows(self.batch)
+
+
+def iter_rows(batch: EntryBatch):
+
+    if isinstance(batch, EntryRun):
+        yield from batch.iter_rows()
+        return
+    for i, timestamp in enumerate(batch.timestamp):
+        yield timestamp, batch, i
+
+
+def merge_batches(batches: list, limit: int = None):
+
+    """
+    Lazily merge batches or runs that are each newest first into one stream of (timestamp, batch, row) tuples,
+    newest first.  Only as many rows as are consumed get compared, so taking the first N costs O(N log k) for k
+    batches
+    """
+    _ = merge(*(iter_rows(batch) for batch in batches if len(batch) > 0), key=lambda row: row[0], reverse=True)
+    return islice(_, limit) if limit is not None else _
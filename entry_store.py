@@ -0,0 +1,249 @@
+from os.path import join
+from tempfile import gettempdir
+from threading import local
+from time import time
+import sqlite3
+from aggregation import Aggregator, AGGREGATIONS, APPROXIMATE_AGGREGATIONS
+from filters import get_sql_condition, register_sql_functions
+
+DB_FILE = join(gettempdir(), "entries.db")
+RETENTION = 7 * 86400           # Entries older than this many seconds are purged on ingest
+PURGE_INTERVAL = 300            # Seconds between purges, as each one has to find every entry past the retention
+ROLLUP_RESOLUTIONS = (3600, 60)  # Seconds covered by each bucket of pre-aggregated counters, coarsest first
+KEYED_RESOLUTION = 3600         # Finest rollups keeping the aggregations by client IP and domain, as they have
+                                # nearly as many keys per minute as there are entries
+COLUMNS = ("timestamp", "elapsed", "client_ip", "status_code", "bytes", "method", "url", "rfc931", "how", "type")
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS entries (
+        location TEXT, server_name TEXT, timestamp REAL, elapsed INTEGER, client_ip TEXT, status_code TEXT,
+        bytes INTEGER, method TEXT, url TEXT, rfc931 TEXT, how TEXT, type TEXT
+    );
+    CREATE INDEX IF NOT EXISTS entries_by_time ON entries (location, server_name, timestamp);
+    CREATE INDEX IF NOT EXISTS entries_by_timestamp ON entries (timestamp);
+    -- For filters with an exact or prefix match.  Substring matches can't use these, so they go by entries_by_time
+    CREATE INDEX IF NOT EXISTS entries_by_client_ip ON entries (location, client_ip, timestamp);
+    CREATE INDEX IF NOT EXISTS entries_by_status_code ON entries (location, status_code, timestamp);
+    CREATE TABLE IF NOT EXISTS ingests (
+        location TEXT, server_name TEXT, object_name TEXT, generation TEXT,
+        start_offset INTEGER, end_offset INTEGER, first_timestamp REAL, tail_check TEXT,
+        PRIMARY KEY (location, server_name)
+    );
+    CREATE TABLE IF NOT EXISTS rollups (
+        location TEXT, server_name TEXT, resolution INTEGER, start INTEGER, name TEXT, key TEXT, bucket INTEGER,
+        value INTEGER,
+        PRIMARY KEY (location, server_name, resolution, start, name, key, bucket)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS rollups_by_start ON rollups (resolution, start);
+"""
+
+_connections = local()
+_last_purges = {}  # database file: when its entries were last purged
+
+
+def get_connection(db_file: str = DB_FILE) -> sqlite3.Connection:
+
+    """
+    Return this thread's connection to the store in a database file, creating the tables the first time
+    """
+    if not hasattr(_connections, 'connections'):
+        _connections.connections = {}
+    if not (connection := _connections.connections.get(db_file)):
+        connection = sqlite3.connect(db_file, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        register_sql_functions(connection)
+        has_rollups = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'rollups'").fetchone()
+        connection.executescript(SCHEMA)
+        if not has_rollups:
+            # Entries stored before rollups existed aren't counted in them, so have everything ingested again
+            connection.executescript("DELETE FROM entries; DELETE FROM ingests;")
+        if 'tail_check' not in (_[1] for _ in connection.execute("PRAGMA table_info(ingests)")):
+            # Without a tail check, appends can't be told from rewrites, so each object gets read again once
+            connection.execute("ALTER TABLE ingests ADD COLUMN tail_check TEXT")
+        _connections.connections[db_file] = connection
+    return connection
+
+
+def get_ingest_state(location: str, server_name: str, db_file: str = DB_FILE) -> dict:
+
+    """
+    Return which object and byte range have already been parsed into the store for a server
+    """
+    _ = get_connection(db_file).execute(
+        "SELECT object_name, generation, start_offset, end_offset, first_timestamp, tail_check FROM ingests "
+        "WHERE location = ? AND server_name = ?", (location, server_name)).fetchone()
+    if not _:
+        return {}
+    return dict(zip(('object_name', 'generation', 'start_offset', 'end_offset', 'first_timestamp', 'tail_check'), _))
+
+
+def get_last_timestamp(location: str, server_name: str, db_file: str = DB_FILE) -> float:
+
+    """
+    Return the timestamp of the newest entry stored for a server
+    """
+    return get_connection(db_file).execute(
+        "SELECT MAX(timestamp) FROM entries WHERE location = ? AND server_name = ?",
+        (location, server_name)).fetchone()[0]
+
+
+def add_rollups(connection: sqlite3.Connection, location: str, server_name: str, rows: list,
+                resolutions: tuple = ROLLUP_RESOLUTIONS) -> None:
+
+    """
+    Add the aggregates of rows, ordered as COLUMNS, to the rollup buckets they fall in.  Rows are aggregated once
+    per bucket of the finest resolution, and those are merged into the coarser buckets.  Buckets finer than
+    KEYED_RESOLUTION leave out the aggregations by client IP and domain
+    """
+    finest = resolutions[-1]
+    buckets = {finest: {}}
+    for row in rows:
+        start = int(row[0]) // finest * finest
+        if (aggregator := buckets[finest].get(start)) is None:
+            aggregator = buckets[finest][start] = Aggregator()
+        aggregator.add((server_name,) + tuple(row))
+    for resolution in resolutions[:-1]:
+        buckets[resolution] = {}
+        for start, aggregator in buckets[finest].items():
+            buckets[resolution].setdefault(start // resolution * resolution, Aggregator()).merge(aggregator)
+
+    connection.executemany(
+        "INSERT INTO rollups VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO UPDATE SET value = value + excluded.value",
+        ((location, server_name, resolution, start, *item) for resolution, aggregators in buckets.items()
+         for start, aggregator in aggregators.items() for item in aggregator.items()
+         if resolution >= KEYED_RESOLUTION or item[0] not in APPROXIMATE_AGGREGATIONS))
+
+
+def save_entries(location: str, server_name: str, chunks, state: dict, replace_from: float = None,
+                 previous: dict = None, db_file: str = DB_FILE) -> bool:
+
+    """
+    Insert parsed rows for a server, count them in the rollups and record how far into its object they reach, in
+    a single transaction.  Rows come as an iterable of lists, such as a generator parsing them a chunk at a time,
+    so they're never all in memory at once.  With replace_from, entries at or after that timestamp are dropped
+    first since the object was rewritten.  Nothing is saved unless the server's ingest state is still previous, as
+    read before the rows were parsed, so another process ingesting the same bytes at the same time doesn't store
+    them twice.  Returns whether the rows were saved
+    """
+    connection = get_connection(db_file)
+    with connection:
+        # Take the write lock before checking, so no other process can save in between
+        connection.execute("BEGIN IMMEDIATE")
+        if get_ingest_state(location, server_name, db_file) != (previous or {}):
+            return False
+        if replace_from is not None:
+            connection.execute("DELETE FROM entries WHERE location = ? AND server_name = ? AND timestamp >= ?",
+                               (location, server_name, replace_from))
+            # Rebuild the rollup buckets the dropped entries were counted in from the entries left in them
+            for resolution in ROLLUP_RESOLUTIONS:
+                start = int(replace_from) // resolution * resolution
+                connection.execute(
+                    "DELETE FROM rollups WHERE location = ? AND server_name = ? AND resolution = ? AND start >= ?",
+                    (location, server_name, resolution, start))
+                add_rollups(connection, location, server_name, connection.execute(
+                    f"SELECT {', '.join(COLUMNS)} FROM entries WHERE location = ? AND server_name = ? "
+                    f"AND timestamp >= ?", (location, server_name, start)).fetchall(), (resolution,))
+        for rows in chunks:
+            connection.executemany(
+                f"INSERT INTO entries (location, server_name, {', '.join(COLUMNS)}) "
+                f"VALUES (?, ?, {', '.join('?' * len(COLUMNS))})",
+                ((location, server_name) + row for row in rows))
+            add_rollups(connection, location, server_name, rows)
+        connection.execute(
+            "INSERT OR REPLACE INTO ingests VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (location, server_name, state['object_name'], state['generation'], state['start_offset'],
+             state['end_offset'], state['first_timestamp'], state['tail_check']))
+    return True
+
+
+def purge_entries(retention: int = RETENTION, interval: int = PURGE_INTERVAL, db_file: str = DB_FILE) -> int:
+
+    """
+    Delete entries and rollup buckets older than the retention period, returning how many entries were removed.
+    Does nothing if the last purge was less than interval seconds ago
+    """
+    if (now := time()) - _last_purges.get(db_file, 0) < interval:
+        return 0
+    _last_purges[db_file] = now
+    cutoff = now - retention
+    connection = get_connection(db_file)
+    with connection:
+        _ = connection.execute("DELETE FROM entries WHERE timestamp < ?", (cutoff,))
+        for resolution in ROLLUP_RESOLUTIONS:
+            connection.execute("DELETE FROM rollups WHERE resolution = ? AND start <= ?",
+                               (resolution, cutoff - resolution))
+    return _.rowcount
+
+
+def query_entries(location: str, server_names: list, time_range: tuple, log_filter: dict = None, limit: int = None,
+                  db_file: str = DB_FILE):
+
+    """
+    Yield stored entries for the servers within the time range, newest first, as (server_name, *COLUMNS) tuples
+    """
+    where = ["location = ?", f"server_name IN ({', '.join('?' * len(server_names))})", "timestamp >= ?",
+             "timestamp < ?"]
+    params = [location, *server_names, time_range[0] + 1, time_range[1]]
+    for k, v in (log_filter or {}).items():
+        if v and k in COLUMNS:
+            condition, values = get_sql_condition(k, v)
+            where.append(condition)
+            params.extend(values)
+
+    yield from get_connection(db_file).execute(
+        f"SELECT server_name, {', '.join(COLUMNS)} FROM entries WHERE {' AND '.join(where)} "
+        f"ORDER BY timestamp DESC{' LIMIT ?' if limit is not None else ''}",
+        params + ([limit] if limit is not None else []))
+
+
+def get_rollup_plan(time_range: tuple, resolutions: tuple = ROLLUP_RESOLUTIONS) -> tuple:
+
+    """
+    Split the seconds of a time range into the rollup buckets that fit entirely inside it, coarsest first, and the
+    spans at its edges that have to be counted from entries.  Returns a list of (resolution, start, end) and a
+    list of (start, end), with ends exclusive
+    """
+    spans = [(time_range[0] + 1, time_range[1])]
+    plan = []
+    for resolution in resolutions:
+        remaining = []
+        for start, end in spans:
+            first, last = -(-start // resolution) * resolution, end // resolution * resolution
+            if first < last:
+                plan.append((resolution, first, last))
+                remaining.extend(_ for _ in ((start, first), (last, end)) if _[0] < _[1])
+            else:
+                remaining.append((start, end))
+        spans = remaining
+    return plan, spans
+
+
+def query_rollups(location: str, server_names: list, time_range: tuple, db_file: str = DB_FILE) -> Aggregator:
+
+    """
+    Return an aggregator holding the counters for the servers within the time range, read from the rollups where
+    they cover whole buckets and counted from the stored entries at the edges.  The aggregations by client IP and
+    domain are also counted from entries where the buckets are finer than KEYED_RESOLUTION
+    """
+    connection = get_connection(db_file)
+    aggregator = Aggregator()
+    keyed = Aggregator({name: AGGREGATIONS[name] for name in APPROXIMATE_AGGREGATIONS}, {})
+    plan, spans = get_rollup_plan(time_range)
+
+    for resolution, start, end in plan:
+        # Stores from before KEYED_RESOLUTION may still hold those aggregations in finer buckets, so skip them
+        excluded = APPROXIMATE_AGGREGATIONS if resolution < KEYED_RESOLUTION else ()
+        aggregator.add_items(connection.execute(
+            f"SELECT name, key, bucket, SUM(value) FROM rollups WHERE location = ? "
+            f"AND server_name IN ({', '.join('?' * len(server_names))}) AND resolution = ? AND start >= ? "
+            f"AND start < ? AND name NOT IN ({', '.join('?' * len(excluded))}) GROUP BY name, key, bucket",
+            (location, *server_names, resolution, start, end, *excluded)))
+        if excluded:
+            for row in query_entries(location, server_names, (start - 1, end), db_file=db_file):
+                keyed.add(row)
+    aggregator.merge(keyed)
+    for start, end in spans:
+        for row in query_entries(location, server_names, (start - 1, end), db_file=db_file):
+            aggregator.add(row)
+
+    return aggregator
@@ -0,0 +1,114 @@
+from functools import lru_cache
+from ipaddress import ip_address, ip_network
+import re
+
+CIDR_FIELDS = ('client_ip',)
+
+
+@lru_cache(maxsize=64)
+def get_network(network: str):
+
+    return ip_network(network, strict=False)
+
+
+@lru_cache(maxsize=64)
+def get_regex(pattern):
+
+    return re.compile(pattern)
+
+
+@lru_cache(maxsize=65536)
+def in_network(ip: str, network: str) -> bool:
+
+    """
+    Given an IP address and a network in CIDR notation, return true if the address is in the network
+    """
+    try:
+        return ip_address(ip) in get_network(network)
+    except ValueError:
+        return False
+
+
+def parse_filter(field: str, value: str) -> tuple:
+
+    """
+    Given a filter field and value, return how the value should be matched and what to match against.  Values are
+    matched as substrings, unless they start with "=" for an exact match or "~" for a regular expression, end with
+    "*" for a prefix, or for client_ip, are a network in CIDR notation
+    """
+    if value.startswith("="):
+        return "exact", value[1:]
+    if value.startswith("~"):
+        return "regex", value[1:]
+    if value.endswith("*"):
+        return "prefix", value[:-1]
+    if field in CIDR_FIELDS and "/" in value:
+        try:
+            get_network(value)
+            return "cidr", value
+        except ValueError:
+            pass
+    return "substring", value
+
+
+def compile_filter(log_filter: dict, positions: dict) -> tuple:
+
+    """
+    Compile a filter once per query.  Returns the byte strings every matching line has to contain, so most lines
+    can be rejected before they're split, and a predicate over a line's split fields, or None when there's nothing
+    to check
+    """
+    needles = []
+    tests = []
+
+    for field, value in (log_filter or {}).items():
+        if not value or field not in positions:
+            continue
+        mode, operand = parse_filter(field, value)
+        i = positions[field]
+        if mode == "regex":
+            search = re.compile(operand.encode()).search
+            tests.append(lambda fields, i=i, search=search: search(fields[i]) is not None)
+        elif mode == "cidr":
+            tests.append(lambda fields, i=i, network=operand: in_network(fields[i].decode(), network))
+        else:
+            operand = operand.encode()
+            needles.append(operand)
+            if mode == "exact":
+                tests.append(lambda fields, i=i, operand=operand: fields[i] == operand)
+            elif mode == "prefix":
+                tests.append(lambda fields, i=i, operand=operand: fields[i].startswith(operand))
+            else:
+                tests.append(lambda fields, i=i, operand=operand: operand in fields[i])
+
+    def matches(fields: list) -> bool:
+
+        return all(test(fields) for test in tests)
+
+    return tuple(needles), matches if tests else None
+
+
+def get_sql_condition(field: str, value: str) -> tuple:
+
+    """
+    Translate a filter field and value into a SQL condition and its parameters.  Exact and prefix matches can use
+    an index on the column.  Regular expressions and networks need the functions from register_sql_functions()
+    """
+    mode, operand = parse_filter(field, value)
+    if mode == "exact":
+        return f"{field} = ?", [operand]
+    if mode == "prefix":
+        return f"{field} >= ? AND {field} < ?", [operand, operand + "\U0010ffff"]
+    if mode == "regex":
+        return f"{field} REGEXP ?", [operand]
+    if mode == "cidr":
+        return f"in_network({field}, ?)", [operand]
+    return f"instr({field}, ?) > 0", [operand]
+
+
+def register_sql_functions(connection):
+
+    connection.create_function(
+        "regexp", 2, lambda pattern, value: value is not None and get_regex(pattern).search(value) is not None,
+        deterministic=True)
+    connection.create_function("in_network", 2, in_network, deterministic=True)
@@ -1,16 +1,40 @@
 from os.path import realpath, dirname, join, exists, getsize
-from asyncio import gather, run
+from os import stat
+from zlib import decompressobj
+from asyncio import gather, get_running_loop, to_thread, Lock
+from atexit import register
+from multiprocessing import get_context
+from itertools import islice, chain
+from functools import lru_cache, partial
+from weakref import WeakKeyDictionary
+from hashlib import sha1
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from os import cpu_count
 from time import time
-from math import floor
-from sys import getsizeof
+from math import floor, ceil, inf
 from collections import deque, Counter
 import tomli
 import json
+try:
+    import zstandard
+except ImportError:
+    zstandard = None    # Only needed to read zstd compressed logs
 from datetime import datetime
 from tempfile import gettempdir
-from gcloud.aio.auth import Token
-from gcloud.aio.storage import Storage
-from google.auth.transport.requests import Request
+from storage_client import StorageClient, get_storage_client, close_storage_clients, MAX_DOWNLOADS
+from background_loop import run_in_background, stop_background_loop
+from entry_store import get_ingest_state, get_last_timestamp, save_entries, purge_entries, query_entries, \
+    query_rollups, COLUMNS as STORE_COLUMNS, DB_FILE
+from entry_batch import EntryBatch, EntryRun, merge_batches
+from aggregation import Aggregator, TimeHistogram, get_host
+from sketches import TOP_K_ERROR, DISTINCT_ERROR
+from filters import compile_filter
+from metadata_store import get_metadata, add_metadata
+from metrics import start_query, count, add_counts, record_stages, record_worker_rss, get_rss, get_peak_rss, \
+    start_profile, stop_profile
+from blob_cache import read_blob_meta, read_blob, map_blob, write_blob, evict_blobs, OVERLAP_SIZE, CACHE_DIR
+from spill import BlobFile, open_blob, release_pages, SPILL_DIR
 
 LOG_FIELD_NAMES = ("timestamp", "elapsed", "client_ip", "status_code", "bytes", "method", "url", "rfc931", "how", "type")
 FILTER_FIELD_NAMES = ('client_ip', 'status_code', 'url')
@@ -19,11 +43,33 @@ IGNORE_STATUS_CODES = ('NONE/000')
 DEFAULT_FILTER = {}
 UNITS = ("KB", "MB", "GB", "TB", "PB")
 STORAGE_TIMEOUT = 55
-REQUEST_COUNT_FIELDS = ('server', 'client_ip', 'method', 'status_code', 'domain')
+RANGE_PROBE_SIZE = 16384        # Bytes read per probe when searching an object for a timestamp
+RANGE_MIN_SPAN = 1048576        # Stop probing once the search has narrowed to this many bytes
 SETTINGS_FILE = 'settings.toml'
 LOCATIONS_FILE = 'locations.toml'
 TEMPDIR = gettempdir()
-SCOPES = ["https://www.googleapis.com/auth/cloud-platform.read-only"]
+PARSE_WORKERS = cpu_count() or 1
+PARALLEL_MIN_BYTES = 1048576    # Blobs smaller than this are parsed in-process, as shipping them costs more
+LINE_CHUNK_SIZE = 65536         # Bytes of lines searched at once for filter values, before reading them line by line
+DECOMPRESS_CHUNK_SIZE = 1048576  # Bytes of a compressed log decompressed at a time
+LOG_ENCODINGS = {'.gz': "gzip", '.zst': "zstd"}  # Extensions of rotated logs and how they're compressed
+CONFIG_CHECK_INTERVAL = 1       # Seconds between checks of whether a config file has changed
+MAX_PLAN_MATCHES = 65536        # Object names a location plan remembers the server and groups of
+HISTOGRAM_BUCKETS = 120         # Buckets a histogram is split into, roughly, unless a bucket size is asked for
+MAX_HISTOGRAM_BUCKETS = 1440
+HISTOGRAM_BUCKET_SIZES = (1, 5, 10, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 10800, 21600, 43200, 86400)
+HISTOGRAM_GROUPS = {'': None, 'server': "server_name", 'status_code': "status_code"}
+SPILL_ROW_BYTES = 256           # Rough memory a parsed entry takes, counting its share of the distinct strings
+SPILL_MIN_ROWS = 1024           # Fewest entries held in memory per log, however small the memory budget
+SPILL_WINDOW_SIZE = 16777216    # Bytes of a mapped blob read before the pages behind them are released
+INGEST_CHUNK_SIZE = 4194304     # Bytes of lines parsed and inserted into the entry store at a time
+
+_process_pool = None
+_config_files = {}              # file name: (checked at, (modified, size), contents)
+_location_plans = {}            # location: (locations the plan was built from, plan)
+_ingest_locks = WeakKeyDictionary()  # event loop: {(location, server name): Lock held while ingesting}
+
+register(stop_background_loop, close_storage_clients)
 
 
 def ping():
@@ -45,74 +91,105 @@ def get_full_path(file_name: str) -> str:
     return full_path
 
 
-def read_cache_file(data_type: str) -> dict:
+def read_toml(file_name: str) -> dict:
+
+    """
+    Return the contents of a TOML file, parsed once and then again only after the file changes.  Whether it has is
+    checked at most every CONFIG_CHECK_INTERVAL seconds.  The contents are shared by every caller, so don't modify them
+    """
+    now = time()
+    checked_at, version, contents = _config_files.get(file_name, (0, None, None))
+    if contents is not None and now - checked_at < CONFIG_CHECK_INTERVAL:
+        return contents
 
     try:
-        cache_file = data_type + ".json"
-        if cache_file := join(TEMPDIR, cache_file):
-            fp = open(cache_file, mode="rb")
-            _ = json.load(fp)
-            fp.close()
-            #print(f"Successfully read cache file for '{data_type}': {cache_file}")
-            return _
+        if path := get_full_path(file_name):
+            _ = stat(path)
+            if (_ := (_.st_mtime_ns, _.st_size)) != version:
+                version = _
+                fp = open(path, mode="rb")
+                contents = tomli.load(fp)
+                fp.close()
+            _config_files[file_name] = (now, version, contents)
+            return contents
     except FileNotFoundError:
+        _config_files.pop(file_name, None)
         return {}
     except Exception as e:
         raise e
 
 
-def write_cache_file(data_type: str, data: dict) -> bool:
+def get_settings() -> dict:
 
-    try:
-        cache_file = data_type + ".json"
-        if cache_file := join(TEMPDIR, cache_file):
-            fp = open(cache_file, mode="w")
-            json.dump(data, fp)
-            fp.close()
-            #print(f"Successfully wrote cache file for '{data_type}': {cache_file}")
-            return True
-    except FileNotFoundError:
-        return False
-    except Exception as e:
-        raise e
+    return read_toml(SETTINGS_FILE)
 
 
-def read_toml(file_name: str) -> dict:
+def get_locations() -> dict:
 
-    try:
-        if _ := get_full_path(file_name):
-            fp = open(_, mode="rb")
-            _ = tomli.load(fp)
-            fp.close()
-            return _
-    except FileNotFoundError:
-        return {}
-    except Exception as e:
-        raise e
+    return read_toml(LOCATIONS_FILE)
 
 
-def get_settings() -> dict:
+def get_location_plan(location: str, locations: dict = None) -> dict:
 
-    return read_toml(SETTINGS_FILE)
+    """
+    Return what every query of a location needs that only depends on its configuration: the bucket and prefix its
+    logs are under, the credentials to read them with and the log fields.  Plans are built once per version of the
+    locations file, and remember which server and server groups each object name they're asked about belongs to
+    """
+    locations = locations or get_locations()
+    source, plan = _location_plans.get(location, (None, None))
+    if source is locations:
+        return plan
 
+    assert locations.get(location), f"Could not find location '{location}' in locations list"
+    _ = locations[location]
+    bucket_type = _.get('bucket_type')
+    auth_file = _.get('auth_file')
+    plan = {
+        'bucket_name': _.get('bucket_name'),
+        'bucket_type': bucket_type,
+        'prefix': _.get('file_path'),
+        # Without an auth file, the client uses application default credentials.  Local buckets need neither
+        'service_file': get_full_path(auth_file) if auth_file and bucket_type != "local" else None,
+        'log_fields': dict(enumerate(LOG_FIELD_NAMES)),
+        'matches': {},          # (object name, server group): server name, or None if not in the group
+    }
+    _location_plans[location] = (locations, plan)
+    return plan
 
-def get_locations() -> dict:
 
-    return read_toml(LOCATIONS_FILE)
+def get_object_server(plan: dict, object_name: str, server_group: str = None) -> str:
 
+    """
+    Given a location plan, return the name of the server an object is the log of if it belongs to the server group,
+    otherwise None
+    """
+    key = (object_name, server_group)
+    if (server_name := plan['matches'].get(key, False)) is False:
+        server_name, _ = get_server_name(object_name)
+        if 'squid_parse_output' in object_name:
+            server_name = None
+        elif server_group and server_group != "all" and server_group not in server_name:
+            server_name = None
+        if len(plan['matches']) >= MAX_PLAN_MATCHES:
+            plan['matches'].clear()
+        plan['matches'][key] = server_name
+    return server_name
 
-def get_servers(filter: str = None) -> dict:
 
-    _ = read_cache_file('servers')
-    return _
+def get_servers(location: str, server_group: str = "all") -> list:
+
+    return get_metadata('servers', location, server_group or "all")
 
 
 def get_client_ips(location: str, server_group: str) -> list:
 
-    _ = read_cache_file('client_ips')
-    if location := _.get(location):
-        return location.get(server_group, [])
-    return []
+    return get_metadata('client_ips', location, server_group)
+
+
+def get_status_codes(location: str) -> list:
+
+    return get_metadata('status_codes', location)
 
 
 def object_is_current(obj: dict, min_timestamp: int = 0) -> bool:
@@ -124,19 +201,74 @@ def object_is_current(obj: dict, min_timestamp: int = 0) -> bool:
     if int(obj.get('size', 0)) == 0:
         return False    # Ignore empty files
 
-    timestamp_format = "%Y-%m-%d%H:%M:%S"
-
-    if updated := obj.get('updated'):
-        updated_ymd = updated[:10]
-        updated_hms = updated[11:19]
-        updated_timestamp = int(datetime.timestamp(datetime.strptime(updated_ymd + updated_hms, timestamp_format)))
+    if (updated_timestamp := get_updated_timestamp(obj)) is not None:
         if updated_timestamp > min_timestamp:
             return True
 
     return False
 
 
-async def list_storage_objects(bucket: str, token: Token, prefix: str = "", time_range: tuple = None) -> list:
+def get_updated_timestamp(obj: dict) -> int:
+
+    """
+    Given a GCS object, return when it was last written to as a timestamp.  GCS gives the time in UTC, such as
+    "2025-01-01T12:00:00.000Z", whatever the local timezone is
+    """
+    if updated := obj.get('updated'):
+        return int(datetime.fromisoformat(updated.replace("Z", "+00:00")).timestamp())
+
+    return None
+
+
+def get_log_encoding(obj: dict) -> str:
+
+    """
+    Given GCS object metadata, return how its contents are compressed once downloaded, or None if they aren't.
+    Objects stored with gzip content encoding are decompressed on the way
+    """
+    if obj.get('contentEncoding') != "gzip":
+        for extension, encoding in LOG_ENCODINGS.items():
+            if obj['name'].endswith(extension):
+                return encoding
+    return None
+
+
+@lru_cache(maxsize=65536)
+def get_server_name(object_name: str) -> tuple:
+
+    """
+    Given a GCS object name, return the server name it's the log of, and whether it's a rotated log rather than
+    the current one.  Rotated logs have a suffix after ".log", such as "web1.log.2.gz" or "web1.log-20250101"
+    """
+    file_name = object_name.split('/')[-1]
+    server_name, _, suffix = file_name.partition('.log')
+    return server_name, suffix != ""
+
+
+def select_log_objects(objects: list, time_range: tuple) -> tuple:
+
+    """
+    Given the current GCS objects of each server's logs, both live and rotated, return each server's live (newest)
+    log, and each server's logs whose time span overlaps the time range, newest first.  A log covers from when the
+    log before it was last written to, up to when it was
+    """
+    logs = {}
+    for o in objects:
+        server_name, _ = get_server_name(o['name'])
+        logs.setdefault(server_name, []).append(o)
+
+    current, overlapping = {}, {}
+    for server_name, server_objects in logs.items():
+        server_objects.sort(key=lambda o: get_updated_timestamp(o) or 0)
+        current[server_name] = server_objects[-1]
+        overlapping[server_name] = [
+            o for i, o in reversed(list(enumerate(server_objects)))
+            if i == 0 or (get_updated_timestamp(server_objects[i - 1]) or 0) < time_range[1]
+        ]
+    return current, overlapping
+
+
+async def list_storage_objects(bucket: str, storage: StorageClient, prefix: str = "", time_range: tuple = None) -> list:
 
     """
     Given a GCS bucket and prefix, return all non-zero byte objects within the specified time range
@@ -148,133 +280,831 @@ async def list_storage_objects(bucket: str, token: Token, prefix: str = "", time
     objects = []
 
     try:
-        async with Storage(token=token) as storage:
-            while True:
-                _ = await storage.list_objects(bucket, params=params, timeout=STORAGE_TIMEOUT)
-                objects.extend(_.get('items', []))
-                if next_page_token := _.get('nextPageToken'):
-                    params.update({'pageToken': next_page_token})
-                else:
-                    break
+        while True:
+            _ = await storage.list_objects(bucket, params=params, timeout=STORAGE_TIMEOUT)
+            objects.extend(_.get('items', []))
+            if next_page_token := _.get('nextPageToken'):
+                params.update({'pageToken': next_page_token})
+            else:
+                break
     except Exception as e:
         raise e
 
     return [o for o in objects if object_is_current(o, time_range[0])]
 
 
-async def get_storage_objects(bucket: str, token: Token, objects: list = ()) -> deque:
+async def find_storage_offset(storage: StorageClient, bucket: str, obj: dict, timestamp: int) -> int:
+
+    """
+    Given a GCS object, probe it with small ranged reads to find the offset of a line at or before timestamp
+    """
+    lo, hi = 0, int(obj.get('size', 0))
+
+    while hi - lo > RANGE_MIN_SPAN:
+        mid = (lo + hi) // 2
+        headers = {'Range': f"bytes={mid}-{mid + RANGE_PROBE_SIZE - 1}"}
+        probe = await storage.download(bucket, obj['name'], headers=headers, timeout=STORAGE_TIMEOUT)
+        if (newline := probe.find(b'\n')) < 0:
+            break  # line is longer than the probe, so settle for what we have
+        if (line_timestamp := get_line_timestamp(probe, newline + 1)) is None:
+            break
+        if line_timestamp <= timestamp:
+            lo = mid + newline + 1
+        else:
+            hi = mid
+
+    return lo
+
+
+def get_tail_check(data: bytes, end: int) -> str:
+
+    """
+    Return a digest of the OVERLAP_SIZE bytes of data before end, or of as many as there are, prefixed by how many.
+    Downloading the same bytes again later and comparing digests tells whether the object was only appended to
+    """
+    start = max(end - OVERLAP_SIZE, 0)
+    return f"{end - start}:{sha1(data[start:end]).hexdigest()}"
+
+
+async def download_appended(storage: StorageClient, bucket: str, obj: dict, offset: int, tail_check: str) -> tuple:
+
+    """
+    Given an object that was read up to offset, and the tail check of the bytes before it, download what was
+    appended since along with those bytes again.  Returns how many bytes were read again and the data, or None if
+    they changed, as the object was rewritten rather than appended to
+    """
+    overlap = int(tail_check.split(":")[0]) if tail_check else -1
+    if not 0 <= overlap <= offset:
+        return None
+    headers = {'Range': f"bytes={offset - overlap}-"}
+    data = await storage.download(bucket, obj['name'], headers=headers, timeout=STORAGE_TIMEOUT)
+    if get_tail_check(data, overlap) != tail_check:
+        return None
+    return overlap, data
+
+
+async def download_storage_object(storage: StorageClient, bucket: str, obj: dict, start_time: int = None,
+                                  spill_dir: str = None) -> tuple:
+
+    """
+    Given GCS object metadata, download it and return the offset the download started at along with the contents.
+    With a start time, only download the tail of the object that can contain lines newer than it.  With a spill
+    directory, the contents are streamed to a BlobFile in it instead of being held in memory
+    """
+    offset, headers = 0, None
+    # Range requests are ignored for objects stored with gzip content encoding, and compressed logs can only be
+    # read from the start
+    if start_time and obj.get('contentEncoding') != "gzip" and not get_log_encoding(obj):
+        if offset := await find_storage_offset(storage, bucket, obj, start_time):
+            count('bytes_skipped', offset)
+            headers = {'Range': f"bytes={offset}-"}
+
+    return offset, await download_storage_range(storage, bucket, obj['name'], headers, spill_dir)
+
+
+async def download_storage_range(storage: StorageClient, bucket: str, object_name: str, headers: dict = None,
+                                 spill_dir: str = None):
+
+    """
+    Download an object, or the range of it asked for in headers, as bytes, or with a spill directory, streamed to
+    a BlobFile in it
+    """
+    if spill_dir:
+        blob = BlobFile(spill_dir)
+        blob.size = await storage.download_to_file(bucket, object_name, blob.path, headers=headers,
+                                                   timeout=STORAGE_TIMEOUT)
+        count('bytes_spilled', blob.size)
+        return blob
+    return await storage.download(bucket, object_name, headers=headers, timeout=STORAGE_TIMEOUT)
+
+
+async def get_cached_storage_object(storage: StorageClient, bucket: str, obj: dict, start_time: int = None,
+                                    cache_dir: str = CACHE_DIR, spill_dir: str = None) -> tuple:
+
+    """
+    Given GCS object metadata, return the offset its contents start at along with the contents, from the blob cache
+    in cache_dir, only downloading what was appended to the object since it was last cached.  With a spill
+    directory, the contents are copied to a BlobFile in it instead of being read into memory, as the cached copy
+    can be evicted before they're parsed
+    """
+    size = int(obj.get('size', 0))
+    meta = read_blob_meta(bucket, obj['name'], cache_dir)
+
+    # The cached copy must reach back far enough to cover the start time
+    if meta and meta['offset'] > 0:
+        if not start_time or not meta.get('first_timestamp') or meta['first_timestamp'] > start_time:
+            meta = {}
+
+    if meta and size >= meta['size'] and (meta['generation'] != obj.get('generation') or size > meta['size']):
+        # Re-read the last few cached bytes along with the new ones, to make sure the object was only appended to
+        overlap = min(OVERLAP_SIZE, meta['size'] - meta['offset'])
+        headers = {'Range': f"bytes={meta['size'] - overlap}-"}
+        data = await storage.download(bucket, obj['name'], headers=headers, timeout=STORAGE_TIMEOUT)
+        if overlap > 0 and data[:overlap] == read_blob(bucket, obj['name'], meta['size'] - meta['offset'] - overlap,
+                                                       cache_dir=cache_dir):
+            meta = write_blob(bucket, obj, data[overlap:], append=True, cache_dir=cache_dir)
+        else:
+            meta = {}
+    elif meta and size < meta['size']:
+        meta = {}  # Object was replaced by a smaller one
+
+    if not meta:
+        count('blob_cache_misses')
+        offset, data = await download_storage_object(storage, bucket, obj, start_time, spill_dir)
+        with open_blob(data) as _:
+            write_blob(bucket, obj, _, offset, get_line_timestamp(_), cache_dir=cache_dir)
+        return offset, data
+
+    count('blob_cache_hits')
+    if meta['size'] == meta['offset']:
+        return meta['offset'], BlobFile(spill_dir) if spill_dir else b""
+    blob = map_blob(bucket, obj['name'], cache_dir)
+    start = find_line_offset(blob, start_time) if start_time else 0
+    if spill_dir:
+        _ = BlobFile(spill_dir)
+        _.write(blob, start)
+        count('bytes_spilled', _.size)
+    else:
+        _ = blob[start:]
+    blob.close()
+    return meta['offset'] + start, _
+
+
+async def get_storage_object(storage: StorageClient, bucket: str, obj, start_time: int = None,
+                             cache_dir: str = None, spill_dir: str = None) -> tuple:
+
+    """
+    Given a GCS object name or metadata, return the offset its contents start at along with the contents, or with
+    a spill directory, a BlobFile holding them.  With a cache directory, they're read through the blob cache kept
+    there
+    """
+    if isinstance(obj, str):
+        return 0, await storage.download(bucket, obj, timeout=STORAGE_TIMEOUT)
+
+    if cache_dir and not get_log_encoding(obj):
+        return await get_cached_storage_object(storage, bucket, obj, start_time, cache_dir, spill_dir)
+
+    return await download_storage_object(storage, bucket, obj, start_time, spill_dir)
+
+
+async def download_storage_delta(storage: StorageClient, bucket: str, obj: dict, position: list) -> tuple:
+
+    """
+    Given GCS object metadata and a cursor position of [generation, offset, timestamp, tail check] from an earlier
+    query, return the offset and contents of what was appended to the object since, and the tail check of the new
+    position.  If it was rewritten rather than appended to, return the part that can contain lines newer than the
+    timestamp instead
+    """
+    generation, offset, timestamp, tail_check = (*position, None)[:4]
+    size = int(obj.get('size', 0))
+    if get_log_encoding(obj):
+        return offset, b"", tail_check  # compressed logs are rotated ones, which don't get appended to
+
+    if 0 < offset <= size and obj.get('contentEncoding') != "gzip":
+        if offset == size and generation == obj.get('generation'):
+            return offset, b"", tail_check
+        # Fetch the new bytes along with the last few read, to prove this is an append
+        if appended := await download_appended(storage, bucket, obj, offset, tail_check):
+            overlap, data = appended
+            return offset, data[overlap:], get_tail_check(data, max(data.rfind(b'\n', overlap) + 1, overlap))
+
+    offset, data = await download_storage_object(storage, bucket, obj, int(timestamp) if timestamp else None)
+    return offset, data, get_tail_check(data, data.rfind(b'\n') + 1)
+
+
+async def get_storage_deltas(bucket: str, storage: StorageClient, objects: list, positions: list) -> list:
 
     """
-    Given a GCS bucket name and list of files, return the contents of the files
+    Given a GCS bucket name, list of files and a cursor position for each, return the offset and contents of what
+    each file gained since its position, and the tail check of its new position
     """
     try:
-        async with Storage(token=token) as storage:
-            tasks = (storage.download(bucket, o, timeout=STORAGE_TIMEOUT) for o in objects)
-            _ = deque(await gather(*tasks))
-        await token.close()
+        tasks = (download_storage_delta(storage, bucket, o, p) for o, p in zip(objects, positions))
+        return await gather(*tasks)
+    except Exception as e:
+        raise e
+
+
+async def get_storage_objects(bucket: str, storage: StorageClient, objects: list = (), start_time: int = None,
+                              cache_size: int = 0, cache_dir: str = CACHE_DIR, spill_dir: str = None) -> deque:
+
+    """
+    Given a GCS bucket name and list of files, return the offset the contents of each file start at along with the
+    contents.  With a cache size, keep local
+    copies of the files in cache_dir so that later calls only download what's been appended.  With a spill
+    directory, the contents are written to BlobFiles in it rather than held in memory
+    """
+    try:
+        tasks = (get_storage_object(storage, bucket, o, start_time, cache_dir if cache_size > 0 else None, spill_dir)
+                 for o in objects)
+        _ = deque(await gather(*tasks))
+        if cache_size > 0:
+            evict_blobs(cache_size, cache_dir)
         return _
     except Exception as e:
         raise e
 
 
-async def process_log(server_name: str, blob: bytes, time_range: tuple, log_filter: dict = None, log_fields: dict = None) -> deque:
+def get_line_timestamp(blob: bytes, offset: int = 0) -> int:
 
-    matches = deque()
+    """
+    Given a blob and the offset of the start of a line, return that line's timestamp in whole seconds
+    """
+    try:
+        return int(blob[offset:offset + 10])
+    except ValueError:
+        return None
+
+
+def find_line_offset(blob: bytes, timestamp: int, lo: int = 0, hi: int = None) -> int:
+
+    """
+    Binary search a blob of time-ordered log lines for the byte offset of the first line newer than timestamp
+    """
+    hi = len(blob) if hi is None else hi
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+        line_start = max(lo, blob.rfind(b'\n', lo, mid) + 1)
+        line_end, line_timestamp = line_start, None
+        while line_timestamp is None and line_end < hi:
+            # Step over any unreadable lines until one with a valid timestamp is found
+            line_timestamp = get_line_timestamp(blob, line_end)
+            line_end = blob.find(b'\n', line_end, hi)
+            line_end = hi if line_end < 0 else line_end + 1
+        if line_timestamp is not None and line_timestamp <= timestamp:
+            lo = line_end  # this line is too old, so search the newer half
+        else:
+            hi = line_start
+
+    return lo
 
-    lines = deque(blob.decode('utf-8').rstrip().splitlines())
-    del blob
 
-    while len(lines) > 0:
+def get_last_line_timestamp(blob: bytes) -> float:
 
-        # Work backwards on file, since newer entries are at the end
-        line = tuple(lines.pop().split())
-        entry = {'server_name': server_name}
-        entry.update({v: line[int(k)] for k, v in log_fields.items()})
+    """
+    Given a blob of log lines, return the full timestamp of its last complete line
+    """
+    end = blob.rfind(b'\n')
+    start = blob.rfind(b'\n', 0, max(end, 0)) + 1
+    try:
+        return float(blob[start:end].split(maxsplit=1)[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def read_lines_reversed(blob: bytes, start: int = 0, end: int = None):
+
+    """
+    Yield the lines of a blob between two byte offsets, newest (last) line first
+    """
+    end = len(blob) if end is None else end
 
-        # Skip lines that have invalid / unexpected data
+    while end > start:
+        line_start = max(start, blob.rfind(b'\n', start, end - 1) + 1)
+        if line := blob[line_start:end].rstrip():
+            yield line
+        end = line_start
+
+
+def read_matching_lines_reversed(blob: bytes, needles: tuple, start: int = 0, end: int = None):
+
+    """
+    Yield the lines of a blob between two byte offsets that contain every needle, newest (last) line first.
+    Lines are searched a chunk at a time, so chunks without a match get skipped without being split into lines
+    """
+    end = len(blob) if end is None else end
+
+    while end > start:
+        chunk_start = max(start, blob.rfind(b'\n', start, max(start, end - LINE_CHUNK_SIZE)) + 1)
+        if all(blob.find(needle, chunk_start, end) >= 0 for needle in needles):
+            for line in read_lines_reversed(blob, chunk_start, end):
+                if all(needle in line for needle in needles):
+                    yield line
+        end = chunk_start
+
+
+def read_blob_lines_reversed(blob: bytes, needles: tuple = (), start: int = 0, end: int = None):
+
+    """
+    Yield the lines of a blob between two byte offsets that contain every needle, newest (last) line first, a
+    window at a time.  Once a window has been read, the pages of a mapped blob it covered are released, so the
+    memory it takes stays at about a window however big the blob is
+    """
+    end = len(blob) if end is None else end
+
+    while end > start:
+        window_start = max(start, blob.rfind(b'\n', start, max(start, end - SPILL_WINDOW_SIZE)) + 1)
+        if needles:
+            yield from read_matching_lines_reversed(blob, needles, window_start, end)
+        else:
+            yield from read_lines_reversed(blob, window_start, end)
+        release_pages(blob, window_start, end)
+        end = window_start
+
+
+def format_entry(entry: dict, timestamp: int) -> dict:
+
+    """
+    Given a raw entry, convert timestamp, elapsed time, size and URL into their human readable forms
+    """
+    time_str = str(datetime.fromtimestamp(timestamp))
+    entry.update({'timestamp': time_str})
+
+    if elapsed := int(entry['elapsed']):
+        unit = "s"
+        if elapsed < 1000:
+            unit = "ms"
+        else:
+            elapsed = elapsed / 1000
+            if elapsed > 60:
+                elapsed = round(elapsed)
+        elapsed_str = f"{elapsed} {unit}"
+    else:
+        elapsed_str = "unknown"
+    entry.update({'elapsed': elapsed_str})
+
+    if size := int(entry['bytes']):
+        unit = "Bytes"
+        if size >= 1000:
+            for i, unit in enumerate(UNITS):
+                size = round(size / 1000, 3)
+                unit = UNITS[i]
+                if size < 1000:
+                    break
+        size_str = f"{size} {unit}"
+    else:
+        size_str = "unknown"
+    entry.update({'size': size_str})
+
+    entry.update({'host': get_host(entry.get('url'))})
+
+    return entry
+
+
+def parse_log_rows(blob: bytes, log_fields: dict) -> list:
+
+    """
+    Parse every complete line of a blob into a tuple of typed values, ordered as the entry store's columns
+    """
+    positions = {v: int(k) for k, v in log_fields.items()}
+    positions = tuple(positions[k] for k in STORE_COLUMNS)
+    rows = []
+
+    for line in blob[:blob.rfind(b'\n') + 1].decode('utf-8', errors="replace").splitlines():
+        line = line.split()
         if len(line) < len(log_fields):
             continue
-        # Skip lines that have special codes
-        if entry['status_code'] in IGNORE_STATUS_CODES:
+        row = [line[i] for i in positions]
+        if row[3] in IGNORE_STATUS_CODES:
             continue
+        try:
+            row[0], row[1], row[4] = float(row[0]), int(row[1]), int(row[4])
+        except ValueError:
+            continue
+        rows.append(tuple(row))
+
+    return rows
+
+
+def parse_log_chunks(blob, log_fields: dict, start: int = 0, chunk_size: int = INGEST_CHUNK_SIZE):
+
+    """
+    Parse the complete lines of a blob from an offset on like parse_log_rows, yielding their rows about chunk_size
+    bytes of lines at a time.  Blobs spilled to a file are mapped while they're read, and their pages released
+    """
+    with open_blob(blob) as data:
+        end = data.rfind(b'\n') + 1
+        while start < end:
+            stop = data.find(b'\n', min(start + chunk_size, end) - 1) + 1
+            yield parse_log_rows(data[start:stop], log_fields)
+            release_pages(data, start, stop)
+            start = stop
 
-        # Check if timestamp is within search range
-        timestamp = int(entry.get('timestamp')[0:10])
-        if timestamp >= time_range[1]:
-            continue  # haven't read enough, so skip this line
-        if timestamp <= time_range[0]:
-            break  # read too far, so break
 
-        if all(not v or v == "" for v in log_filter.values()):
-            match = True
+async def ingest_storage_object(storage: StorageClient, bucket: str, location: str, server_name: str, obj: dict,
+                                start_time: int, log_fields: dict, spill_dir: str = None,
+                                db_file: str = DB_FILE) -> int:
+
+    """
+    Parse whatever part of a GCS object since start time isn't in the entry store yet, and save it, a chunk of
+    lines at a time.  With a spill directory, full downloads are streamed to a BlobFile in it rather than held in
+    memory.  Returns the number of bytes that had to be parsed
+    """
+    # Queries of the same location share the event loop, so only one of them ingests a server's new bytes at a
+    # time; the others then find them already stored.  Parsing and saving run in a thread to keep the loop free
+    locks = _ingest_locks.setdefault(get_running_loop(), {})
+    async with locks.setdefault((location, server_name), Lock()):
+        size = int(obj.get('size', 0))
+        previous = get_ingest_state(location, server_name, db_file)
+        state = dict(previous)
+        replace_from = None
+        parts = []                      # Iterables of row chunks to save, oldest first
+        parsed = 0
+
+        if state and state['object_name'] == obj['name'] and size >= state['end_offset']:
+            if size > state['end_offset'] or state['generation'] != obj.get('generation'):
+                # Fetch the new bytes along with the last few ingested, to prove this is an append
+                if appended := await download_appended(storage, bucket, obj, state['end_offset'], state['tail_check']):
+                    overlap, data = appended
+                    parts.append(parse_log_chunks(data, log_fields, overlap))
+                    end = max(data.rfind(b'\n', overlap) + 1, overlap)
+                    state['end_offset'] += end - overlap
+                    state['tail_check'] = get_tail_check(data, end)
+                    parsed += len(data) - overlap
+                else:
+                    state = {}
         else:
-            match = False
-            #print("log_filter:", log_filter)
-            for k, v in log_filter.items():
-                if not v or v == "":
+            state = {}  # New, truncated or rotated object; what's already stored is still valid history
+
+        if not state:
+            # Nothing usable stored for this object yet, so start from the time range.  Anything stored for the
+            # server that overlaps with the new data is replaced by it
+            offset, data = await download_storage_object(storage, bucket, obj, start_time, spill_dir)
+            with open_blob(data) as _:
+                end = _.rfind(b'\n') + 1
+                tail_check = get_tail_check(_, end)
+            chunks = parse_log_chunks(data, log_fields)
+            # Only the first rows are needed up front, for the time the new data starts at
+            first = await to_thread(next, (_ for _ in chunks if _), [])
+            parts = [chain([first], chunks)]
+            replace_from = first[0][0] if first else None
+            state = {
+                'object_name': obj['name'],
+                'generation': obj.get('generation'),
+                'start_offset': offset,
+                'end_offset': offset + end,
+                'first_timestamp': first[0][0] if first else start_time,
+                'tail_check': tail_check,
+            }
+            parsed += len(data)
+        elif state['start_offset'] > 0 and state['first_timestamp'] > start_time:
+            # Stored entries don't reach back far enough, so fill in the older part of the object
+            offset = await find_storage_offset(storage, bucket,
+                                               {'name': obj['name'], 'size': state['start_offset']}, start_time)
+            headers = {'Range': f"bytes={offset}-{state['start_offset'] - 1}"}
+            data = await download_storage_range(storage, bucket, obj['name'], headers, spill_dir)
+            chunks = parse_log_chunks(data, log_fields)
+            if first := await to_thread(next, (_ for _ in chunks if _), []):
+                parts.insert(0, chain([first], chunks))
+                state['first_timestamp'] = first[0][0]
+            state['start_offset'] = offset
+            parsed += len(data)
+
+        state['generation'] = obj.get('generation')
+        await to_thread(save_entries, location, server_name, chain.from_iterable(parts), state, replace_from,
+                        previous, db_file)
+        return parsed
+
+
+async def ingest_storage_objects(bucket: str, storage: StorageClient, location: str, objects: dict, start_time: int,
+                                 log_fields: dict, spill_dir: str = None, db_file: str = DB_FILE) -> int:
+
+    """
+    Given a dictionary of server names and their GCS objects, bring the entry store in db_file up to date with them
+    """
+    try:
+        tasks = (ingest_storage_object(storage, bucket, location, server_name, obj, start_time, log_fields,
+                                       spill_dir, db_file)
+                 for server_name, obj in objects.items())
+        _ = sum(await gather(*tasks))
+        await to_thread(purge_entries, db_file=db_file)
+        return _
+    except Exception as e:
+        raise e
+
+
+def read_entry_store(location: str, server_names: list, time_range: tuple, log_filter: dict, max_rows: int,
+                     summary: bool, aggregator: Aggregator, use_rollups: bool = False, db_file: str = DB_FILE) -> list:
+
+    """
+    Read the stored entries of the servers within the time range into a batch per server, newest first, counting
+    them into the aggregator.  With use_rollups, the counters come from the rollups and only the entries kept are
+    read
+    """
+    batches = {server_name: EntryBatch(server_name) for server_name in server_names}
+    if use_rollups:
+        aggregator.merge(query_rollups(location, server_names, time_range, db_file))
+        for row in query_entries(location, server_names, time_range, log_filter, max_rows, db_file):
+            batches[row[0]].append(*row[1:])
+    else:
+        kept = 0
+        for row in query_entries(location, server_names, time_range, log_filter, None if summary else max_rows,
+                                 db_file):
+            if max_rows is None or kept < max_rows:
+                batches[row[0]].append(*row[1:])
+                kept += 1
+            aggregator.add(row)
+    return list(batches.values())
+
+
+def decompress_chunks(blob: bytes, encoding: str):
+
+    """
+    Yield the decompressed contents of a gzip or zstd compressed blob a chunk at a time, so the whole of it never
+    has to be held in memory.  Gzip blobs are also fed to the decompressor a chunk at a time, releasing the pages
+    of a mapped blob once they're consumed
+    """
+    if encoding == "zstd":
+        if not zstandard:
+            raise ModuleNotFoundError("The zstandard package is needed to read zstd compressed logs")
+        reader = zstandard.ZstdDecompressor().stream_reader(blob, read_across_frames=True)
+        while chunk := reader.read(DECOMPRESS_CHUNK_SIZE):
+            yield chunk
+        return
+
+    decompressor, data, position = decompressobj(wbits=47), b"", 0
+    while data or position < len(blob):
+        if not data:
+            data = blob[position:position + DECOMPRESS_CHUNK_SIZE]
+            release_pages(blob, 0, position := position + len(data))
+        if chunk := decompressor.decompress(data, DECOMPRESS_CHUNK_SIZE):
+            yield chunk
+        data = decompressor.unconsumed_tail
+        if decompressor.eof:
+            # Concatenated gzip members are decompressed one after another
+            decompressor, data = decompressobj(wbits=47), decompressor.unused_data
+    if chunk := decompressor.flush():
+        yield chunk
+
+
+def read_compressed_lines(blob: bytes, encoding: str, time_range: tuple, needles: tuple = ()):
+
+    """
+    Yield the lines of a compressed blob, oldest first, as it's decompressed.  Chunks of lines entirely before the
+    time range or without every needle are skipped whole, and decompression stops once past the time range
+    """
+    rest = b""
+
+    for chunk in decompress_chunks(blob, encoding):
+        chunk = rest + chunk
+        end = chunk.rfind(b'\n') + 1
+        rest = chunk[end:]
+        if (first_timestamp := get_line_timestamp(chunk)) is not None and first_timestamp >= time_range[1]:
+            return
+        last_line = chunk.rfind(b'\n', 0, max(end - 1, 0)) + 1
+        if (last_timestamp := get_line_timestamp(chunk, last_line)) is not None and last_timestamp <= time_range[0]:
+            continue
+        if all(chunk.find(needle, 0, end) >= 0 for needle in needles):
+            for line in chunk[:end].splitlines():
+                if line and all(needle in line for needle in needles):
+                    yield line
+
+    if rest.strip() and all(needle in rest for needle in needles):
+        yield rest
+
+
+def parse_lines(server_name: str, lines, time_range: tuple, log_fields: dict, matches=None, after: float = None,
+                counts: Counter = None):
+
+    """
+    Given raw log lines, yield each valid line that passes the compiled filter and falls in the time range as a
+    row of values in the order of ROW_FIELD_NAMES.  With after, only lines with a timestamp later than it are kept.
+    With counts, the number of lines read is added to its lines_scanned, even if the caller stops early
+    """
+    positions = {v: int(k) for k, v in log_fields.items()}
+    columns = tuple(positions[k] for k in LOG_FIELD_NAMES)
+    scanned = 0
+
+    try:
+        for scanned, line in enumerate(lines, 1):
+
+            # Skip entry if filter specified, but no match.  This runs on the raw line, before it's decoded
+            if matches:
+                fields = line.split()
+                if len(fields) < len(log_fields) or not matches(fields):
                     continue
-                if v in entry.get(k):
-                    match = True
-                else:
-                    match = False
-                    break
-        if not match:
-            continue  # Skip entry if filter specified, but no match
 
-        time_str = str(datetime.fromtimestamp(timestamp))
-        entry.update({'timestamp': time_str})
+            line = line.decode('utf-8').split()
+
+            # Skip lines that have invalid / unexpected data
+            if len(line) < len(log_fields):
+                continue
+
+            # Skip lines that have special codes
+            if line[positions['status_code']] in IGNORE_STATUS_CODES:
+                continue
+
+            try:
+                timestamp, elapsed, client_ip, status_code, size, *strings = (line[i] for i in columns)
+                timestamp = float(timestamp)
+                # Check if timestamp is within search range
+                if int(timestamp) >= time_range[1] or int(timestamp) <= time_range[0]:
+                    continue  # slightly out of order line near the edges of the range
+                if after is not None and timestamp <= after:
+                    continue  # already returned by an earlier query
+                yield server_name, timestamp, int(elapsed), client_ip, status_code, int(size), *strings
+            except ValueError:
+                continue
+    finally:
+        if counts is not None:
+            counts['lines_scanned'] += scanned
+
+
+def process_log(server_name: str, blob: bytes, time_range: tuple, log_filter: dict = None,
+                log_fields: dict = None, *, max_rows: int = None, summary: bool = True, after: float = None,
+                approximate: dict = None, encoding: str = None, histogram: dict = None,
+                spill_rows: int = None, spill_dir: str = SPILL_DIR) -> tuple:
 
-        if elapsed := int(entry['elapsed']):
-            unit = "s"
-            if elapsed < 1000:
-                unit = "ms"
-            else:
-                elapsed = elapsed / 1000
-                if elapsed > 60:
-                    elapsed = round(elapsed)
-            elapsed_str = f"{elapsed} {unit}"
-        else:
-            elapsed_str = "unknown"
-        entry.update({'elapsed': elapsed_str})
-
-        if size := int(entry['bytes']):
-            unit = "Bytes"
-            if size >= 1000:
-                for i, unit in enumerate(UNITS):
-                    size = round(size / 1000, 3)
-                    unit = UNITS[i]
-                    if size < 1000:
-                        break
-            size_str = f"{size} {unit}"
-        else:
-            size_str = "unknown"
-        entry.update({'size': size_str})
-
-        if url := entry.get('url'):
-            if url.startswith("http:"):
-                # Remove full URL from HTTP requests
-                host = url[7:].split('/')[0]
-                host = host if ":" in host else f"{host}:80"
-            else:
-                host = url
+    """
+    Parse the lines of a blob in the time range into a batch of entries, newest first, aggregating them in the same
+    pass.  Returns the batch, or an EntryRun if it spilled to disk, the Aggregator or TimeHistogram, and counts of
+    the lines and bytes that were scanned, matched, skipped and spilled
+    """
+    batch = EntryRun(server_name, spill_rows, spill_dir) if spill_rows else EntryBatch(server_name)
+    aggregator = TimeHistogram(**histogram) if histogram else Aggregator(**(approximate or {}))
+    counts = Counter()
+    positions = {v: int(k) for k, v in log_fields.items()}
+    needles, matches = compile_filter(log_filter, positions)
+    matched = 0
+
+    if encoding:
+        # Compressed logs can only be read oldest first, so hold on to the newest rows as they go by
+        rows = deque(maxlen=max_rows)
+        lines = read_compressed_lines(blob, encoding, time_range, needles)
+        for matched, row in enumerate(parse_lines(server_name, lines, time_range, log_fields, matches, after,
+                                                  counts), 1):
+            rows.append(row)
+            if summary:
+                aggregator.add(row)
+            if spill_rows and max_rows is None and len(rows) >= spill_rows:
+                # Spill each chunk newest first as it fills, and read the chunks back in reverse
+                while rows:
+                    batch.append(*rows.pop()[1:])
+        while rows:
+            batch.append(*rows.pop()[1:])
+        counts['lines_matched'] = matched
+        if spill_rows:
+            if max_rows is None:
+                batch.reverse()
+            counts['bytes_spilled'] = batch.spilled_bytes
+            batch = batch.finish()
+        return batch, aggregator, counts
+
+    # Only the lines inside the time range get decoded, so find their byte offsets first
+    start = find_line_offset(blob, time_range[0])
+    end = find_line_offset(blob, time_range[1] - 1, lo=start)
+    counts['bytes_skipped'] = len(blob) - (end - start)
+
+    # Work backwards on file, since newer entries are at the end
+    lines = read_blob_lines_reversed(blob, needles, start, end)
+    rows = parse_lines(server_name, lines, time_range, log_fields, matches, after, counts)
+    for matched, row in enumerate(rows, 1):
+        if max_rows is not None and len(batch) >= max_rows:
+            if not summary:
+                break
         else:
-            host = "unknownhost.unknowndomain"
-        entry.update({'host': host})
+            batch.append(*row[1:])
+        aggregator.add(row)
+    rows.close()
+    counts['lines_matched'] = matched
+    if spill_rows:
+        counts['bytes_spilled'] = batch.spilled_bytes
+        batch = batch.finish()
+
+    return batch, aggregator, counts
 
-        matches.append(entry)
 
-    return matches
+def parse_blob(parse: partial, server_name: str, blob, encoding: str = None) -> tuple:
 
+    """
+    Run process_log, with the options bound to parse, over a blob, mapping it first if it was spilled to a file
+    """
+    with open_blob(blob) as _:
+        return parse(server_name, _, encoding=encoding)
+
+
+def process_log_in_worker(parse: partial, server_name: str, blob, encoding: str = None) -> tuple:
+
+    """
+    Run parse_blob in a parse worker, and add the worker's peak resident memory to what it returns
+    """
+    return *parse_blob(parse, server_name, blob, encoding), get_peak_rss()
+
+
+def get_histogram_bucket_size(time_range: tuple, bucket_size: str = "") -> int:
+
+    """
+    Return the width in seconds of a histogram's buckets.  Unless a width is asked for, it's the smallest round
+    width that splits the time range into HISTOGRAM_BUCKETS buckets or fewer.  Either way, there's never more than
+    MAX_HISTOGRAM_BUCKETS
+    """
+    span = max(time_range[1] - time_range[0], 1)
+    if bucket_size not in ("", "0"):
+        return max(int(bucket_size), ceil(span / MAX_HISTOGRAM_BUCKETS))
+    return next((_ for _ in HISTOGRAM_BUCKET_SIZES if _ * HISTOGRAM_BUCKETS >= span), ceil(span / HISTOGRAM_BUCKETS))
+
+
+def get_process_pool(max_workers: int = PARSE_WORKERS) -> ProcessPoolExecutor:
+
+    """
+    Return this process's pool of parse workers, starting it on first use
+    """
+    global _process_pool
+
+    if not _process_pool:
+        # Forking a process that runs the background loop thread isn't safe, so start workers from a clean server
+        _process_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=get_context("forkserver"))
+    return _process_pool
+
+
+def reset_process_pool(pool: ProcessPoolExecutor):
+
+    """
+    Drop a pool that broke because a worker died, so the next call to get_process_pool starts a new one
+    """
+    global _process_pool
 
-async def get_data(env_vars: dict = None) -> dict:
+    if _process_pool is pool:
+        _process_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def process_logs(server_names: list, blobs: deque, time_range: tuple, log_filter: dict = None,
+                       log_fields: dict = None, workers: int = PARSE_WORKERS, max_rows: int = None,
+                       summary: bool = True, approximate: dict = None, encodings: list = None,
+                       histogram: dict = None, spill_rows: int = None, spill_dir: str = SPILL_DIR) -> list:
+
+    """
+    Run process_log over each blob, spreading the larger blobs over a pool of worker processes.  The others are
+    parsed one at a time in a thread, so other queries on the event loop keep going meanwhile.  Server names can
+    repeat when a server has more than one log in the time range.  What was scanned is added to the query's
+    metrics, and a (batch, aggregator) tuple per blob is returned
+    """
+    loop = get_running_loop()
+    pool = get_process_pool(workers) if workers > 1 else None
+    parse = partial(process_log, time_range=time_range, log_filter=log_filter, log_fields=log_fields,
+                    max_rows=max_rows, summary=summary, approximate=approximate, histogram=histogram,
+                    spill_rows=spill_rows, spill_dir=spill_dir)
+
+    results = []
+    for server_name, blob, encoding in zip(server_names, blobs, encodings or [None] * len(blobs)):
+        future = None
+        if pool and pool is _process_pool and len(blob) >= PARALLEL_MIN_BYTES:
+            try:
+                future = loop.run_in_executor(pool, process_log_in_worker, parse, server_name, blob, encoding)
+            except BrokenProcessPool:
+                # A worker died while the pool was idle
+                reset_process_pool(pool)
+        results.append((server_name, blob, encoding, future))
+
+    processed = []
+    for server_name, blob, encoding, future in results:
+        _ = None
+        if future:
+            try:
+                *_, worker_rss = await future
+                record_worker_rss(worker_rss)
+            except BrokenProcessPool:
+                # A worker died, most likely killed for running out of memory, and took the pool with it.  The next
+                # query starts a new pool, and the blobs it was parsing are parsed in-process instead
+                reset_process_pool(pool)
+        if _ is None:
+            _ = await to_thread(parse_blob, parse, server_name, blob, encoding)
+        batch, aggregator, counts = _
+        add_counts(counts)
+        processed.append((batch, aggregator))
+    return processed
+
+
+async def get_data(env_vars: dict = None, stream: bool = False, histogram: bool = False) -> dict:
+
+    """
+    Query the logs of a location.  When streaming, the entries are returned as a generator that formats each one
+    as it's consumed, instead of a list.  With histogram, the time range is charted in buckets instead of returning
+    entries and counters.  The result includes the query's metrics, and with profile set, when the PROFILING
+    setting allows it, a cProfile report of the query
+    """
+    query = start_query()
+    profiler = None
+    if str(env_vars.get('profile', "")) not in ("", "0", "false") and get_settings().get('PROFILING', False):
+        profiler = start_profile()
+
+    try:
+        data = await query_logs(env_vars, stream, histogram)
+    except Exception as e:
+        count('query_errors')
+        raise e
+    finally:
+        profile = stop_profile(profiler)
+
+    data['metrics'] = query.results()
+    if profile:
+        data['profile'] = profile
+    return data
+
+
+async def query_logs(env_vars: dict, stream: bool = False, histogram: bool = False) -> dict:
+
+    """
+    Run a get_data() query, timing each stage of it
+    """
 
     splits = {'start': time()}
 
     settings = get_settings()
     default_values = settings.get('DEFAULT_VALUES', {})
     assert settings, "Could not load settings.  Does {} exist?".format(SETTINGS_FILE)
-    #if not (log_fields := settings.get('LOG_FIELDS')):
-    log_fields = dict(enumerate(LOG_FIELD_NAMES))
     splits['get_settings'] = time()
 
     locations = get_locations()
@@ -301,18 +1131,55 @@ async def get_data(env_vars: dict = None) -> dict:
     start_time = int(env_vars.get('start_time', end_time - interval))
     time_range = (start_time, end_time)
 
+    # With a cursor returned by an earlier query, only entries added since are returned, along with what they add
+    # to the counters.  The cursor maps each server to [generation, byte offset, timestamp, tail check] of the last
+    # line read
+    cursor = env_vars.get('cursor', "")
+    cursor = json.loads(cursor) if cursor != "" else None
+
+    # Parse parameters to determine which page of entries to return.  Unless asked for, counters are skipped when
+    # paging so parsing can stop as soon as there's enough entries.  Deltas are never paged, as the cursor moves
+    # past every line read
+    limit = str(env_vars.get('limit', default_values.get('limit', ""))) if cursor is None else ""
+    limit = int(limit) if limit != "" else None
+    offset = int(env_vars.get('offset') or 0)
+    summary = env_vars.get('summary', "1" if limit is None else "0") not in ("", "0", "false")
+    max_rows = offset + limit if limit is not None else None
+
+    # With top_k, client IP and domain counters only keep their top K keys, approximately, and distinct client IPs
+    # and domains are estimated.  That bounds memory and response size when there's too many of them to list
+    top_k = str(env_vars.get('top_k', settings.get('TOP_K', "")))
+    approximate = {}
+    if top_k not in ("", "0"):
+        approximate = {
+            'top_k': int(top_k),
+            'top_k_error': float(settings.get('TOP_K_ERROR', TOP_K_ERROR)),
+            'distinct_error': float(settings.get('DISTINCT_ERROR', DISTINCT_ERROR)),
+        }
+
+    # A histogram counts every line in the time range into buckets, optionally per server or status code, in the
+    # same pass that would otherwise aggregate them.  No entries are kept, so nothing is paged or approximated
+    histogram_options = None
+    if histogram:
+        assert (group_by := env_vars.get('group_by', "")) in HISTOGRAM_GROUPS, f"Can't group by '{group_by}'"
+        cursor, limit, offset, summary, max_rows, approximate = None, None, 0, True, 0, {}
+        histogram_options = {
+            'time_range': time_range,
+            'bucket_size': get_histogram_bucket_size(time_range, str(env_vars.get('bucket_size', ""))),
+            'group_by': HISTOGRAM_GROUPS[group_by],
+        }
+
     # Parse parameters to determine filter
     filter = {k: env_vars.get(k, "") for k in FILTER_FIELD_NAMES}
 
     # Populate variables
     if not (location := env_vars.get('location')):
         location = default_values.get('location', list(locations.keys())[0])
-    assert locations.get(location), f"Could not find location '{location}' in locations list"
-    _ = locations[location]
-    bucket_name = _.get('bucket_name')
-    bucket_type = _.get('bucket_type')
-    file_path = _.get('file_path')
-    auth_file = _.get('auth_file')
+    plan = get_location_plan(location, locations)
+    bucket_name = plan['bucket_name']
+    bucket_type = plan['bucket_type']
+    file_path = plan['prefix']
+    log_fields = plan['log_fields']
     server_group = env_vars.get('server_group')
     servers = {location: []}
 
@@ -323,140 +1190,191 @@ async def get_data(env_vars: dict = None) -> dict:
     splits['get_servers'] = time()
 
     try:
-        token = None
-        credentials = None
-        if auth_file:
-            _ = get_full_path(auth_file)
-            token = Token(service_file=_, scopes=SCOPES)
-        else:
-            credentials, project_id = default(scopes=SCOPES)
-            _ = Request()
-            credentials.refresh(_)
-            token = credentials.token
+        storage = get_storage_client(plan['service_file'], int(settings.get('MAX_DOWNLOADS', MAX_DOWNLOADS)),
+                                     bucket_type)
+        if bucket_type != "local":
+            await storage.token.get()
     except Exception as e:
         raise e
     splits['get_token'] = time()
 
-    objects = await list_storage_objects(bucket_name, token=token, prefix=file_path, time_range=time_range)
+    objects = await list_storage_objects(bucket_name, storage, prefix=file_path, time_range=time_range)
     splits['list_objects'] = time()
 
-    request_counts = {k: {} for k in REQUEST_COUNT_FIELDS}
+    aggregator = TimeHistogram(**histogram_options) if histogram_options else Aggregator(**approximate)
 
-    # Populate list of files to read from bucket
-    file_names = {}
-    while len(objects) > 0:
-        o = objects.pop()
-        if 'squid_parse_output' in o['name']:
-            continue
-        server_name = o['name'].split('/')[-1].replace('.log', '')
-        match = True
-        if server_group and server_group != "" and server_group != "all":
-            if server_group not in server_name:
-                match = False
-        if match:
-            servers[location].append(server_name)
-            file_names.update({server_name: o['name']})
-            request_counts['server'].update({server_name: 0})
+    # Populate list of files to read from bucket.  Which server and groups each object belongs to is remembered by
+    # the plan, so this is a lookup for objects seen before
+    candidates = [o for o in reversed(objects) if get_object_server(plan, o['name'], server_group) is not None]
+    # Each server's live log, and the logs covering the time range, which can include rotated ones
+    file_names, log_objects = select_log_objects(candidates, time_range)
+    for server_name in file_names:
+        servers[location].append(server_name)
+        aggregator.add_keys('server_name', [server_name])
     splits['filter_objects'] = time()
 
     # Read the objects from the bucket
     server_names = list(file_names.keys())
-    object_names = list(file_names.values())
-    blobs = await get_storage_objects(bucket_name, token, object_names)
-    splits['read_objects'] = time()
-
-    byte_counts = {k: {} for k in ['server', 'client_ip', 'domain']}
-
-    entries = deque()
-    for i, server_name in enumerate(server_names):
-        _blob = blobs.popleft()
-        matches = await process_log(server_name, _blob, time_range, filter, log_fields)
-        # Inject the server name as a new field
-        #print(server)
-        #matches = [match.update({'server': server}) for match in matches]
-        entries.extend(matches)
-        request_counts['server'].update({server_name: len(matches)})
-        byte_counts['server'].update({server_name: 69})
+    objects = list(file_names.values())
+    # Rotated logs aren't ingested into the entry store, so time ranges that reach into them are parsed directly
+    live_logs_only = all(o is file_names[server_name] and not get_log_encoding(o)
+                         for server_name, server_objects in log_objects.items() for o in server_objects)
+    range_start = start_time if settings.get('RANGE_READS', True) else None
+    cache_size = int(settings.get('BLOB_CACHE_MAX_BYTES', 0))
+    cache_dir = settings.get('BLOB_CACHE_DIR', CACHE_DIR)
+    # With a memory budget, objects are written to spill files rather than held in memory, and each log's parsed
+    # entries beyond its share of the budget are spilled to disk, so memory use no longer grows with the time range
+    memory_budget = int(settings.get('MEMORY_BUDGET', 0))
+    spill_dir = settings.get('SPILL_DIR', SPILL_DIR)
+    db_file = settings.get('ENTRY_STORE_FILE', DB_FILE)
+    new_cursor = {}
+    if cursor is not None:
+        # Read just the bytes appended to each object since the cursor.  Servers that are new to the cursor start
+        # from the time range
+        positions = [cursor.get(server_name) or [None, 0, start_time] for server_name in server_names]
+        deltas = await get_storage_deltas(bucket_name, storage, objects, positions)
+        blobs = deque(data for _, data, _ in deltas)
+        splits['read_objects'] = time()
+        batches = []
+        for server_name, obj, (_, _, timestamp, *_), (delta_start, data, tail_check) in zip(server_names, objects,
+                                                                                          positions, deltas):
+            batch, server_aggregator, counts = await to_thread(process_log, server_name, data,
+                                                               (floor(timestamp) - 1, inf), filter, log_fields,
+                                                               after=timestamp, approximate=approximate)
+            add_counts(counts)
+            batches.append(batch)
+            aggregator.merge(server_aggregator)
+            new_cursor[server_name] = [obj.get('generation'), delta_start + data.rfind(b'\n') + 1,
+                                       get_last_line_timestamp(data) or timestamp, tail_check]
+    elif settings.get('ENTRY_STORE', False) and live_logs_only:
+        # Parse only what's new since the last ingest, then answer the time range from the store's index
+        blobs = deque()
+        await ingest_storage_objects(bucket_name, storage, location, file_names, start_time, log_fields,
+                                     spill_dir if memory_budget > 0 else None, db_file)
+        splits['read_objects'] = time()
+        # Without a filter, the counters can come from the rollups, so only the entries shown get read
+        use_rollups = summary and not any(filter.values()) and settings.get('ROLLUPS', True) and not histogram_options
+        batches = await to_thread(read_entry_store, location, server_names, time_range, filter, max_rows, summary,
+                                  aggregator, use_rollups, db_file)
+        for server_name in server_names:
+            state = get_ingest_state(location, server_name, db_file)
+            new_cursor[server_name] = [state['generation'], state['end_offset'],
+                                       get_last_timestamp(location, server_name, db_file) or start_time,
+                                       state['tail_check']]
+    else:
+        read_names = [server_name for server_name, server_objects in log_objects.items() for _ in server_objects]
+        read_objects = [o for server_objects in log_objects.values() for o in server_objects]
+        downloads = await get_storage_objects(bucket_name, storage, read_objects, range_start, cache_size, cache_dir,
+                                              spill_dir if memory_budget > 0 else None)
+        blobs = deque(data for _, data in downloads)
+        splits['read_objects'] = time()
+        # The cursor ends after the last complete line read, like the deltas' do, so a line the blob ends partway
+        # through is read whole by the next delta.  That holds even if the object grew since it was listed
+        for server_name, obj, (blob_start, blob) in zip(read_names, read_objects, downloads):
+            if obj is file_names[server_name]:
+                with open_blob(blob) as _:
+                    end = _.rfind(b'\n') + 1
+                    last_timestamp, tail_check = get_last_line_timestamp(_), get_tail_check(_, end)
+                new_cursor[server_name] = [obj.get('generation'), blob_start + end, last_timestamp or start_time,
+                                           tail_check]
+        workers = int(settings.get('PARSE_WORKERS', PARSE_WORKERS))
+        encodings = [get_log_encoding(o) for o in read_objects]
+        spill_rows = None
+        if memory_budget > 0:
+            # Every log being parsed at once, and every run being merged, holds up to this many entries in memory
+            spill_rows = max(SPILL_MIN_ROWS, memory_budget // (SPILL_ROW_BYTES * max(len(blobs), workers + 1)))
+        results = await process_logs(read_names, blobs, time_range, filter, log_fields, workers, max_rows, summary,
+                                     approximate, encodings, histogram_options, spill_rows, spill_dir)
+        batches = [batch for batch, _ in results]
+        for _, server_aggregator in results:
+            aggregator.merge(server_aggregator)
     splits['process_objects'] = time()
-    matches = []
-
-    # Perform Total Counts
-    for field in ('client_ip', 'status_code', 'method'):
-        request_counts[field] = Counter([_.get(field) for _ in entries])
-
-    request_counts.update({
-        'domain': Counter([_['host'][7:].split("/")[0] if _['host'].startswith("http:") else _['host'] for _ in entries]),
-        'how':  Counter([_['how'].split("/")[0] for _ in entries]),
-    })
-    for _ in entries:
-        _client_ip = _['client_ip']
-        _bytes = int(_['bytes'])
-        byte_counts['client_ip'][_client_ip] = byte_counts['client_ip'].get(_client_ip, 0) + _bytes
+
+    # Counts were done while parsing, so just summarize them.  Percentiles can't be added together, so deltas only
+    # carry the counters
+    if not summary:
+        totals = {}
+    elif cursor is None:
+        totals = aggregator.results()
+    else:
+        totals = {k: v for k, v in aggregator.results().items() if k not in aggregator.histograms}
     splits['do_counts'] = time()
 
-    # Sort by timestamp reversed, so that latest entries are first in the list
-    entries = sorted(entries, key=lambda x: x['timestamp'], reverse=True)
+    # Each server's batch is already newest first, so merge them rather than sort, keeping the latest entries
+    # first in the list.  Only the merged rows get materialized as dictionaries
+    rows = islice(merge_batches(batches, max_rows), offset, None)
+    entries = (format_entry(batch.get_entry(i), int(ts)) for ts, batch, i in rows)
+    if not stream:
+        entries = list(entries)
     splits['sort_entries'] = time()
 
-    status_codes = read_cache_file('status_codes')
-    if location not in status_codes:
-        #status_codes[location] = list(DEFAULT_STATUS_CODES)
-        status_codes[location] = list(default_values.get('STATUS_CODES', DEFAULT_STATUS_CODES))
-    #print("request counts:", request_counts)
-    #print("status_codes:", status_codes)
-
-    status_codes[location] = list(set(status_codes[location] + list(request_counts['status_code'].keys())))
-    #print("status_codes:", status_codes)
-    _ = write_cache_file('status_codes', status_codes)
+    # Only keys that are new, or haven't been recorded for a while, get written to the metadata store
+    status_codes = set(default_values.get('STATUS_CODES', DEFAULT_STATUS_CODES))
+    status_codes |= {status_code for batch in batches for status_code in batch.get_status_codes()}
+    add_metadata('status_codes', location, status_codes)
+    add_metadata('servers', location, server_names, server_group or "all")
     splits['save_status_codes'] = time()
 
-    if server_group:
-        # Update Client IPs Cache
-        client_ips = read_cache_file('client_ips')
-        if location not in client_ips:
-            client_ips[location] = {server_group: []}
-        client_ips[location][server_group] = list(request_counts['client_ip'].keys())
-        write_cache_file('client_ips', client_ips)
+    if server_group and summary and not histogram_options:
+        add_metadata('client_ips', location, totals['requests_by_client_ip'].keys(), server_group)
     splits['save_client_ips'] = time()
 
     last_split = splits['start']
     durations = {}
+    seconds = {}
     for key, timestamp in splits.items():
         if key != 'start':
-            duration = round((splits[key] - last_split), 3)
+            seconds[key] = splits[key] - last_split
+            duration = round(seconds[key], 3)
             durations[key] = f"{duration:.3f}"
             last_split = timestamp
-    durations['total'] = f"{round(last_split - splits['start'], 3):.3f}"
+    seconds['total'] = last_split - splits['start']
+    durations['total'] = f"{round(seconds['total'], 3):.3f}"
+    record_stages(seconds)
 
+    # Bytes actually held in memory, rather than the size of the containers holding them or of spill files
     sizes = {
-        'objects': getsizeof(objects),
-        'blobs': sum([getsizeof(o) for o in blobs]),
-        'entries': getsizeof(entries),
-        'request_counts': getsizeof(request_counts),
-        'matches': sum([getsizeof(o) for o in matches]),
+        'blobs': sum(len(blob) for blob in blobs if not isinstance(blob, BlobFile)),
+        'rss': get_rss(),
+        'peak_rss': get_peak_rss(),
     }
+    if histogram_options:
+        return {
+            'filter': filter,
+            **totals,
+            'durations': durations,
+            'sizes': sizes,
+            'time_range': time_range,
+        }
     return {
         'entries': entries,
         'filter': filter,
-        'requests_by_server': request_counts['server'],
-        'requests_by_client_ip': request_counts['client_ip'],
-        'requests_by_method': request_counts['method'],
-        'requests_by_domain': request_counts['domain'],
-        'requests_by_status_code': request_counts['status_code'],
-        'requests_by_how': request_counts['how'],
-        'bytes_by_client_ip': byte_counts['client_ip'],
+        'limit': limit,
+        'offset': offset,
+        'total_entries': sum(totals['requests_by_server'].values()) if summary else None,
+        **totals,
         'durations': durations,
         'sizes': sizes,
         'time_range': time_range,
+        'cursor': new_cursor,
         #'num_servers': len(servers[location]),
     }
 
 
+def run_get_data(env_vars: dict = None, stream: bool = False, histogram: bool = False) -> dict:
+
+    """
+    Run get_data() on this process's background event loop, so requests from different threads overlap their
+    storage I/O and the storage clients stay open between them
+    """
+    return run_in_background(get_data(env_vars, stream, histogram))
+
+
 if __name__ == '__main__':
 
     try:
         arguments = {}
-        _ = run(get_data(arguments))
+        _ = run_get_data(arguments)
         print(_['durations'], "\n", _['sizes'])
     except Exception as e:
         quit(e)
@@ -0,0 +1,133 @@
+from os import O_APPEND, O_CREAT, O_WRONLY, open as os_open, write, close, stat, replace, getpid
+from os.path import join
+from tempfile import gettempdir
+from threading import Lock
+from time import time
+import json
+
+JOURNAL_FILE = join(gettempdir(), "metadata.jsonl")
+RETENTION = 7 * 86400           # Keys not seen for this many seconds are dropped
+REFRESH = 3600                  # Keys already in the journal are only written again once they're this many seconds old
+MAX_JOURNAL_BYTES = 4194304     # Journal size at which it's compacted down to the keys still being kept
+
+
+class MetadataStore:
+
+    """
+    Sets of keys, such as the status codes and client IPs seen at a location, shared by every process through an
+    append-only journal.  Each line of the journal records when some keys of one set were last seen, and is added
+    with a single append, so writers never take a lock or rewrite what others wrote.  Each process keeps the sets in
+    memory and only reads the lines added since it last looked, or the whole journal again once it's been compacted
+    """
+
+    def __init__(self, path: str = JOURNAL_FILE, retention: int = RETENTION, refresh: int = REFRESH,
+                 max_bytes: int = MAX_JOURNAL_BYTES):
+
+        self.path = path
+        self.retention = retention
+        self.refresh = refresh
+        self.max_bytes = max_bytes
+        self.sets = {}                  # (data type, location, group): {key: last seen}
+        self.inode = None
+        self.offset = 0
+        self.compacted_size = 0
+        self.lock = Lock()
+
+    def _load(self):
+
+        """
+        Fold whatever was appended to the journal since the last look into the sets in memory.  A journal that was
+        replaced or shrank was compacted, so it's read again from the start
+        """
+        try:
+            _ = stat(self.path)
+        except FileNotFoundError:
+            self.sets, self.inode, self.offset = {}, None, 0
+            return
+        if _.st_ino != self.inode or _.st_size < self.offset:
+            self.sets, self.inode, self.offset = {}, _.st_ino, 0
+        if _.st_size == self.offset:
+            return
+
+        with open(self.path, "rb") as fp:
+            fp.seek(self.offset)
+            data = fp.read(_.st_size - self.offset)
+        # A line still being written is left for next time
+        data = data[:data.rfind(b'\n') + 1]
+        self.offset += len(data)
+        for line in data.splitlines():
+            try:
+                data_type, location, group, keys = json.loads(line)
+            except ValueError:
+                continue
+            values = self.sets.setdefault((data_type, location, group), {})
+            for key, last_seen in keys.items():
+                if last_seen > values.get(key, 0):
+                    values[key] = last_seen
+
+    def get(self, data_type: str, location: str, group: str = "") -> list:
+
+        """
+        Return the keys of a set that were seen within the retention period, sorted
+        """
+        with self.lock:
+            self._load()
+            min_timestamp = time() - self.retention
+            return sorted(k for k, v in self.sets.get((data_type, location, group), {}).items() if v >= min_timestamp)
+
+    def add(self, data_type: str, location: str, keys, group: str = "") -> int:
+
+        """
+        Record that the keys were just seen.  Only keys that are new, or haven't been written for a while, get
+        appended to the journal.  Returns how many were
+        """
+        now = round(time())
+        with self.lock:
+            self._load()
+            values = self.sets.setdefault((data_type, location, group), {})
+            stale = {k: now for k in keys if values.get(k, 0) < now - self.refresh}
+            if not stale:
+                return 0
+            line = json.dumps([data_type, location, group, stale]).encode() + b'\n'
+            fd = os_open(self.path, O_WRONLY | O_APPEND | O_CREAT, 0o644)
+            try:
+                write(fd, line)
+            finally:
+                close(fd)
+            values.update(stale)
+            # Compacting again is only worth it once the journal has grown well past what's kept
+            if self.offset + len(line) > max(self.max_bytes, 2 * self.compacted_size):
+                self._compact()
+        return len(stale)
+
+    def _compact(self):
+
+        """
+        Replace the journal with one line per set, holding only the keys still being kept.  Lines other processes
+        append in between are lost, but as they no longer see their keys once they load the new journal, they
+        write them again the next time they're seen
+        """
+        self._load()
+        min_timestamp = time() - self.retention
+        temp_path = f"{self.path}.{getpid()}"
+        with open(temp_path, "wb") as fp:
+            for (data_type, location, group), values in self.sets.items():
+                if keys := {k: v for k, v in values.items() if v >= min_timestamp}:
+                    fp.write(json.dumps([data_type, location, group, keys]).encode() + b'\n')
+        replace(temp_path, self.path)
+        self.sets, self.inode, self.offset = {}, None, 0
+        self._load()
+        self.compacted_size = self.offset
+
+
+_store = MetadataStore()
+
+
+def get_metadata(data_type: str, location: str, group: str = "") -> list:
+
+    return _store.get(data_type, location, group)
+
+
+def add_metadata(data_type: str, location: str, keys, group: str = "") -> int:
+
+    return _store.add(data_type, location, keys, group)
@@ -0,0 +1,186 @@
+from collections import Counter
+from contextvars import ContextVar
+from cProfile import Profile
+from io import StringIO
+from os import sysconf
+from pstats import Stats
+from resource import getrusage, RUSAGE_SELF
+from sys import platform
+from threading import Lock
+
+PREFIX = "squid_log_view"
+PROFILE_LINES = 40              # Functions listed in a profile report
+COUNTERS = {
+    # Name: help text.  Every counter is kept per query and in total for the process
+    'queries': "Queries run by get_data",
+    'query_errors': "Queries that raised an exception",
+    'bytes_downloaded': "Bytes downloaded from storage",
+    'bytes_skipped': "Bytes of logs skipped by range reads or for being outside the time range",
+    'lines_scanned': "Log lines read by the parser",
+    'lines_matched': "Log lines in the time range that passed the filter",
+    'bytes_spilled': "Bytes of objects and parsed entries written to spill files to stay within the memory budget",
+    'blob_cache_hits': "Objects served from the local blob cache, possibly with what was appended since",
+    'blob_cache_misses': "Objects downloaded because the local blob cache couldn't serve them",
+    'result_cache_hits': "Requests answered with a cached or in-flight result",
+    'result_cache_misses': "Requests that had to compute their result",
+}
+
+_query = ContextVar('query', default=None)
+_lock = Lock()
+_totals = Counter()             # counter: value
+_stages = {}                    # stage: [seconds, count]
+_worker_peak_rss = 0
+_profile_lock = Lock()
+
+
+class QueryMetrics:
+
+    """
+    Counters for one query.  Started as the query begins, they follow it into every coroutine and thread it starts
+    """
+    __slots__ = ('counters',)
+
+    def __init__(self):
+
+        self.counters = Counter()
+
+    def results(self) -> dict:
+
+        _ = {k: self.counters[k] for k in COUNTERS if k not in ('queries', 'query_errors', 'result_cache_hits',
+                                                                  'result_cache_misses')}
+        if lookups := _['blob_cache_hits'] + _['blob_cache_misses']:
+            _['blob_cache_hit_ratio'] = round(_['blob_cache_hits'] / lookups, 3)
+        return _
+
+
+def start_query() -> QueryMetrics:
+
+    """
+    Start counting for a query in the current context, and return its counters
+    """
+    _query.set(_ := QueryMetrics())
+    count('queries')
+    return _
+
+
+def count(name: str, value: int = 1):
+
+    """
+    Add to a counter of the current query, if any, and of the process
+    """
+    if (query := _query.get()) is not None:
+        query.counters[name] += value
+    with _lock:
+        _totals[name] += value
+
+
+def add_counts(counts: dict):
+
+    for name, value in counts.items():
+        count(name, value)
+
+
+def record_stages(durations: dict):
+
+    """
+    Add the seconds a query spent in each stage to the process totals
+    """
+    with _lock:
+        for stage, seconds in durations.items():
+            _ = _stages.setdefault(stage, [0.0, 0])
+            _[0] += seconds
+            _[1] += 1
+
+
+def record_worker_rss(value: int):
+
+    """
+    Keep the highest resident memory reported by a parse worker
+    """
+    global _worker_peak_rss
+
+    with _lock:
+        _worker_peak_rss = max(_worker_peak_rss, value)
+
+
+def get_rss() -> int:
+
+    """
+    Return the current resident memory of this process in bytes, or None where it can't be read cheaply
+    """
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def get_peak_rss() -> int:
+
+    """
+    Return the highest resident memory of this process so far in bytes
+    """
+    _ = getrusage(RUSAGE_SELF).ru_maxrss
+    return _ if platform == "darwin" else _ * 1024
+
+
+def start_profile() -> Profile:
+
+    """
+    Start profiling the calling thread, unless a profile is already running.  Everything running on the thread is
+    included, so queries overlapping on the background loop show up in each other's profiles
+    """
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    profiler = Profile()
+    profiler.enable()
+    return profiler
+
+
+def stop_profile(profiler: Profile, lines: int = PROFILE_LINES) -> str:
+
+    """
+    Stop a profile and return a report of the functions that took the most cumulative time
+    """
+    if not profiler:
+        return None
+    try:
+        profiler.disable()
+        Stats(profiler, stream=(_ := StringIO())).sort_stats("cumulative").print_stats(lines)
+        return _.getvalue()
+    finally:
+        _profile_lock.release()
+
+
+def render_metrics(gauges: dict = None) -> str:
+
+    """
+    Return the process's counters, stage timings and memory in the Prometheus text format.  Gauges are extra
+    values to include, such as from caches
+    """
+    with _lock:
+        totals, worker_peak_rss = Counter(_totals), _worker_peak_rss
+        stages = {k: tuple(v) for k, v in _stages.items()}
+
+    lines = []
+    for name, text in COUNTERS.items():
+        lines += [f"# HELP {PREFIX}_{name}_total {text}", f"# TYPE {PREFIX}_{name}_total counter",
+                  f"{PREFIX}_{name}_total {totals[name]}"]
+
+    lines += [f"# HELP {PREFIX}_stage_seconds Seconds get_data spent in each stage",
+              f"# TYPE {PREFIX}_stage_seconds summary"]
+    for stage, (seconds, n) in stages.items():
+        lines += [f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} {seconds:.6f}',
+                  f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} {n}']
+
+    gauges = {
+        'resident_memory_bytes': ("Current resident memory of this process", get_rss()),
+        'peak_resident_memory_bytes': ("Highest resident memory of this process", get_peak_rss()),
+        'worker_peak_resident_memory_bytes': ("Highest resident memory of a parse worker", worker_peak_rss or None),
+        **(gauges or {}),
+    }
+    for name, (text, value) in gauges.items():
+        if value is not None:
+            lines += [f"# HELP {PREFIX}_{name} {text}", f"# TYPE {PREFIX}_{name} gauge", f"{PREFIX}_{name} {value}"]
+
+    return "\n".join(lines) + "\n"
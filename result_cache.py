@@ -0,0 +1,104 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+from math import floor
+from sys import getsizeof
+from threading import Lock
+from time import time
+from metrics import count
+
+TTL = 5                         # Seconds a result is served from the cache
+MAX_BYTES = 67108864            # Approximate memory the cached results may use before the oldest are evicted
+BUCKET_SIZE = 5                 # end_time is rounded down to this many seconds when building the key
+IGNORE_PARAMETERS = ('stream', 'format')
+
+
+def get_result_size(data: dict) -> int:
+
+    """
+    Roughly estimate the memory used by a get_data() result, by measuring one entry and scaling up
+    """
+    size = getsizeof(data)
+    if entries := data.get('entries'):
+        entry = entries[0]
+        size += len(entries) * (getsizeof(entry) + sum(getsizeof(v) for v in entry.values()))
+    for k, v in data.items():
+        if k != 'entries' and isinstance(v, dict):
+            size += getsizeof(v) + 100 * len(v)
+    return size
+
+
+def get_result_key(env_vars: dict, bucket_size: int = BUCKET_SIZE) -> tuple:
+
+    """
+    Normalize query parameters into a cache key, so requests a few seconds apart for the same thing share a result
+    """
+    params = {k: v for k, v in env_vars.items() if v != "" and k not in IGNORE_PARAMETERS}
+    end_time = int(params.pop('end_time', time()))
+    params['end_time'] = floor(end_time / bucket_size) if bucket_size > 0 else end_time
+    return tuple(sorted(params.items()))
+
+
+class ResultCache:
+
+    """
+    Keeps recent query results in memory for a short time.  Identical requests that arrive while a result is
+    still being computed wait for that computation instead of starting their own
+    """
+
+    def __init__(self, ttl: int = TTL, max_bytes: int = MAX_BYTES):
+
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.results = OrderedDict()    # key: (expires, size, data)
+        self.in_flight = {}             # key: Future
+        self.total_bytes = 0
+        self.lock = Lock()
+
+    def _evict(self, now: float):
+
+        for key in [k for k, (expires, _, _) in self.results.items() if expires <= now]:
+            self.total_bytes -= self.results.pop(key)[1]
+        while self.results and self.total_bytes > self.max_bytes:
+            self.total_bytes -= self.results.popitem(last=False)[1][1]
+
+    def get(self, key: tuple, compute):
+
+        """
+        Return the cached result for the key, or call compute() to produce it
+        """
+        with self.lock:
+            now = time()
+            self._evict(now)
+            if key in self.results:
+                self.results.move_to_end(key)
+                count('result_cache_hits')
+                return self.results[key][2]
+            if future := self.in_flight.get(key):
+                leader = False
+            else:
+                future = self.in_flight[key] = Future()
+                leader = True
+
+        if not leader:
+            count('result_cache_hits')
+            return future.result()
+        count('result_cache_misses')
+
+        try:
+            data = compute()
+        except Exception as e:
+            with self.lock:
+                del self.in_flight[key]
+            future.set_exception(e)
+            raise e
+
+        # Store the result before releasing the key, so no other request starts computing it in between
+        size = get_result_size(data) if self.ttl > 0 else 0
+        with self.lock:
+            if self.ttl > 0 and size <= self.max_bytes:
+                self.results[key] = (time() + self.ttl, size, data)
+                self.total_bytes += size
+                self._evict(time())
+            del self.in_flight[key]
+        future.set_result(data)
+        return data
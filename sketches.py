@@ -0,0 +1,113 @@
+from functools import lru_cache
+from hashlib import blake2b
+from math import ceil, log, log2
+from operator import itemgetter
+
+TOP_K_ERROR = 0.001             # Top-K counts are under by at most this fraction of the total they were counted from
+DISTINCT_ERROR = 0.01           # Relative standard error of distinct counts
+
+
+@lru_cache(maxsize=65536)
+def hash_key(key: str) -> int:
+
+    """
+    Return a 64-bit hash of a key that's the same in every process, unlike hash()
+    """
+    return int.from_bytes(blake2b(str(key).encode(), digest_size=8).digest(), "big")
+
+
+class TopK:
+
+    """
+    Misra-Gries summary, the mergeable form of Space-Saving, of the heaviest keys in a stream of weighted updates.
+    Memory is bounded by the error: each count is under its true value by at most max_error, which is at most
+    the error times the total weight seen.  Supports counter[key] += weight, like a Counter
+    """
+    __slots__ = ('k', 'capacity', 'counts', 'max_error')
+
+    def __init__(self, k: int, error: float = TOP_K_ERROR):
+
+        self.k = k
+        self.capacity = max(k, ceil(1 / error))
+        self.counts = {}
+        self.max_error = 0
+
+    def __getitem__(self, key) -> int:
+
+        return self.counts.get(key, 0)
+
+    def __setitem__(self, key, value: int):
+
+        self.counts[key] = value
+        # Prune in batches, so each update stays O(1) on average
+        if len(self.counts) > 2 * self.capacity:
+            self._prune()
+
+    def __len__(self) -> int:
+
+        return len(self.counts)
+
+    def _prune(self):
+
+        """
+        Drop back to capacity keys by taking the weight of the first key that doesn't fit off every count
+        """
+        counts = sorted(self.counts.values(), reverse=True)
+        if len(counts) > self.capacity and (decrement := counts[self.capacity]) > 0:
+            self.counts = {k: v - decrement for k, v in self.counts.items() if v > decrement}
+            self.max_error += decrement
+
+    def items(self):
+
+        return self.counts.items()
+
+    def update(self, other):
+
+        """
+        Add another summary, or a mapping of exact counts
+        """
+        for key, value in other.items():
+            self.counts[key] = self.counts.get(key, 0) + value
+        if isinstance(other, TopK):
+            self.max_error += other.max_error
+        if len(self.counts) > self.capacity:
+            self._prune()
+
+    def most_common(self, n: int = None) -> list:
+
+        return sorted(self.counts.items(), key=itemgetter(1), reverse=True)[:self.k if n is None else n]
+
+
+class HyperLogLog:
+
+    """
+    Estimates the number of distinct keys in a stream in fixed memory.  Summaries of the same precision are merged
+    by taking the highest of each register
+    """
+    __slots__ = ('precision', 'registers')
+
+    def __init__(self, error: float = DISTINCT_ERROR):
+
+        # Standard error is about 1.04 / sqrt(number of registers)
+        self.precision = min(max(ceil(log2((1.04 / error) ** 2)), 4), 18)
+        self.registers = bytearray(1 << self.precision)
+
+    def add(self, key):
+
+        x = hash_key(key)
+        rest = 64 - self.precision
+        i, rank = x >> rest, rest - (x & ((1 << rest) - 1)).bit_length() + 1
+        if rank > self.registers[i]:
+            self.registers[i] = rank
+
+    def update(self, other: "HyperLogLog"):
+
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        if estimate <= 2.5 * m and (zeros := self.registers.count(0)):
+            estimate = m * log(m / zeros)  # small counts are more accurate from the share of empty registers
+        return round(estimate)
@@ -0,0 +1,113 @@
+from contextlib import nullcontext
+from mmap import mmap, ACCESS_READ, PAGESIZE
+from os import makedirs, remove, close
+from os.path import join
+from tempfile import gettempdir, mkstemp
+from weakref import finalize
+try:
+    from mmap import MADV_DONTNEED
+except ImportError:
+    MADV_DONTNEED = None
+
+SPILL_DIR = join(gettempdir(), "spill")
+
+
+def remove_file(path: str):
+
+    try:
+        remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class SpillFile:
+
+    """
+    Temporary file for data that doesn't fit in the memory budget, removed once nothing refers to it.  Unless
+    hand_over is off, the file belongs to whichever copy was pickled last, so a file made in a worker process and
+    returned to the parent is removed by the parent
+    """
+    hand_over = True
+
+    def __init__(self, suffix: str = "", directory: str = SPILL_DIR):
+
+        makedirs(directory, exist_ok=True)
+        fd, self.path = mkstemp(suffix=suffix, dir=directory)
+        close(fd)
+        self._finalizer = finalize(self, remove_file, self.path)
+
+    def __getstate__(self) -> dict:
+
+        if self.hand_over:
+            self._finalizer.detach()
+        return {k: v for k, v in self.__dict__.items() if k != '_finalizer'}
+
+    def __setstate__(self, state: dict):
+
+        self.__dict__.update(state)
+        self._finalizer = finalize(self, remove_file, self.path) if self.hand_over else None
+
+    def remove(self):
+
+        if self._finalizer:
+            self._finalizer()
+
+
+class BlobFile(SpillFile):
+
+    """
+    Contents of a storage object written to a spill file rather than held as bytes.  Opening it maps the file, so
+    the parser can search and slice it without reading it all in.  Workers only read a copy, so the file stays with
+    the process that downloaded it, which can parse it again if a worker dies
+    """
+    hand_over = False
+
+    def __init__(self, directory: str = SPILL_DIR):
+
+        super().__init__(".log", directory)
+        self.size = 0
+
+    def __len__(self) -> int:
+
+        return self.size
+
+    def write(self, data, start: int = 0):
+
+        """
+        Store a bytes-like object, such as a mapped blob, from a given offset on
+        """
+        with memoryview(data)[start:] as view, open(self.path, "wb") as fp:
+            fp.write(view)
+            self.size = len(view)
+
+    def open(self):
+
+        """
+        Return a context manager giving the contents as a memory map, or as empty bytes if there's none, as empty
+        files can't be mapped
+        """
+        if not self.size:
+            return nullcontext(b"")
+        fp = open(self.path, "rb")
+        _ = mmap(fp.fileno(), 0, access=ACCESS_READ)
+        fp.close()
+        return _
+
+
+def open_blob(blob):
+
+    """
+    Return a context manager giving a bytes-like view of a blob, whether it's held in memory or spilled to a file
+    """
+    return blob.open() if isinstance(blob, BlobFile) else nullcontext(blob)
+
+
+def release_pages(blob, start: int, end: int):
+
+    """
+    Let the kernel drop the pages of a mapped blob between two offsets once they've been read, so they stop
+    counting towards resident memory.  They're read from the file again if needed.  Blobs in memory are left alone
+    """
+    start = -(-start // PAGESIZE) * PAGESIZE
+    if isinstance(blob, mmap) and MADV_DONTNEED is not None and start < end:
+        blob.madvise(MADV_DONTNEED, start, end - start)
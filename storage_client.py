@@ -0,0 +1,174 @@
+from asyncio import Semaphore, get_running_loop, to_thread
+from datetime import datetime, timezone
+from os import walk, stat
+from os.path import join, relpath
+from weakref import WeakKeyDictionary
+from aiohttp import ClientSession, TCPConnector
+from gcloud.aio.auth import Token
+from gcloud.aio.storage import Storage
+from metrics import count
+
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform.read-only"]
+MAX_CONNECTIONS = 32            # Size of the HTTP connection pool shared by every call made through a client
+MAX_DOWNLOADS = 8               # Downloads allowed in flight at once per client; the rest wait their turn
+DOWNLOAD_CHUNK_SIZE = 1048576   # Bytes read at a time when a download is written to a file
+
+_clients = WeakKeyDictionary()  # event loop: {service file: StorageClient}
+_token_states = {}              # service file: (access token, duration, acquired at)
+
+
+class StorageClient:
+
+    """
+    Long-lived GCS client: one pooled HTTP session and access token shared by every list and download, with a
+    limit on how many downloads run at once
+    """
+
+    def __init__(self, service_file: str = None, max_downloads: int = MAX_DOWNLOADS):
+
+        self.service_file = service_file
+        self.session = ClientSession(connector=TCPConnector(limit=MAX_CONNECTIONS, ttl_dns_cache=300))
+        # Token falls back to application default credentials when there's no service file, and refreshes
+        # itself once half of its lifetime has passed
+        self.token = Token(service_file=service_file, scopes=SCOPES, session=self.session)
+        if state := _token_states.get(service_file):
+            self.token.access_token, self.token.access_token_duration, self.token.access_token_acquired_at = state
+        self.storage = Storage(token=self.token, session=self.session)
+        self.downloads = Semaphore(max_downloads)
+
+    async def list_objects(self, bucket: str, **kwargs) -> dict:
+
+        return await self.storage.list_objects(bucket, **kwargs)
+
+    async def download(self, bucket: str, object_name: str, **kwargs) -> bytes:
+
+        async with self.downloads:
+            data = await self.storage.download(bucket, object_name, **kwargs)
+        count('bytes_downloaded', len(data))
+        return data
+
+    async def download_to_file(self, bucket: str, object_name: str, path: str, **kwargs) -> int:
+
+        """
+        Stream an object to a file a chunk at a time, rather than holding it in memory.  Returns its size
+        """
+        size = 0
+        async with self.downloads:
+            response = await self.storage.download_stream(bucket, object_name, **kwargs)
+            async with response:
+                with open(path, "wb") as fp:
+                    while chunk := await response.read(DOWNLOAD_CHUNK_SIZE):
+                        fp.write(chunk)
+                        size += len(chunk)
+        count('bytes_downloaded', size)
+        return size
+
+    async def close(self):
+
+        # Keep the access token, so a client created on another event loop doesn't have to fetch a new one
+        if self.token.access_token:
+            _token_states[self.service_file] = (self.token.access_token, self.token.access_token_duration,
+                                                self.token.access_token_acquired_at)
+        await self.session.close()
+
+
+class LocalStorageClient:
+
+    """
+    Serves directories on the local filesystem the way StorageClient serves GCS buckets, for running offline and
+    benchmarking.  Bucket names are directory paths, and object names are paths relative to them
+    """
+
+    def __init__(self, max_downloads: int = MAX_DOWNLOADS):
+
+        self.downloads = Semaphore(max_downloads)
+
+    async def list_objects(self, bucket: str, params: dict = None, **kwargs) -> dict:
+
+        prefix = (params or {}).get('prefix', "")
+        items = []
+        for directory, _, file_names in walk(bucket):
+            for file_name in file_names:
+                path = join(directory, file_name)
+                if (name := relpath(path, bucket).replace("\\", "/")).startswith(prefix):
+                    _ = stat(path)
+                    updated = datetime.fromtimestamp(_.st_mtime, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+                    items.append({'name': name, 'size': str(_.st_size), 'generation': str(_.st_mtime_ns),
+                                  'updated': updated})
+        return {'items': items}
+
+    def _get_range(self, headers: dict = None) -> tuple:
+
+        """
+        Return the offset and length of a Range header, with a length of -1 for the rest of the object
+        """
+        if headers and (_ := headers.get('Range', "")).startswith("bytes="):
+            start, end = _[6:].split("-")
+            return int(start), int(end) + 1 - int(start) if end else -1
+        return 0, -1
+
+    def _read(self, bucket: str, object_name: str, headers: dict = None) -> bytes:
+
+        start, length = self._get_range(headers)
+        with open(join(bucket, object_name), "rb") as fp:
+            fp.seek(start)
+            return fp.read(length)
+
+    def _copy(self, bucket: str, object_name: str, path: str, headers: dict = None) -> int:
+
+        start, length = self._get_range(headers)
+        size = 0
+        with open(join(bucket, object_name), "rb") as source, open(path, "wb") as fp:
+            source.seek(start)
+            while length < 0 or size < length:
+                if not (chunk := source.read(DOWNLOAD_CHUNK_SIZE if length < 0 else
+                                             min(DOWNLOAD_CHUNK_SIZE, length - size))):
+                    break
+                fp.write(chunk)
+                size += len(chunk)
+        return size
+
+    async def download(self, bucket: str, object_name: str, headers: dict = None, **kwargs) -> bytes:
+
+        async with self.downloads:
+            data = await to_thread(self._read, bucket, object_name, headers)
+        count('bytes_downloaded', len(data))
+        return data
+
+    async def download_to_file(self, bucket: str, object_name: str, path: str, headers: dict = None,
+                               **kwargs) -> int:
+
+        async with self.downloads:
+            size = await to_thread(self._copy, bucket, object_name, path, headers)
+        count('bytes_downloaded', size)
+        return size
+
+    async def close(self):
+
+        pass
+
+
+def get_storage_client(service_file: str = None, max_downloads: int = MAX_DOWNLOADS,
+                       bucket_type: str = None) -> StorageClient:
+
+    """
+    Return the client for these credentials on the running event loop, creating it on first use.  A bucket type of
+    "local" returns a client for directories on the local filesystem instead
+    """
+    clients = _clients.setdefault(get_running_loop(), {})
+    key = bucket_type if bucket_type == "local" else service_file
+    if not (client := clients.get(key)):
+        if bucket_type == "local":
+            client = clients[key] = LocalStorageClient(max_downloads)
+        else:
+            client = clients[key] = StorageClient(service_file, max_downloads)
+    return client
+
+
+async def close_storage_clients():
+
+    """
+    Close every client created on the running event loop
+    """
+    for client in _clients.pop(get_running_loop(), {}).values():
+        await client.close()
@@ -0,0 +1,127 @@
+from asyncio import gather, run
+from os import makedirs
+from os.path import join
+from time import time
+import entry_store
+import main
+from storage_client import LocalStorageClient
+
+LOG_FIELDS = {'0': "timestamp", '1': "elapsed", '2': "client_ip", '3': "status_code", '4': "bytes", '5': "method",
+              '6': "url", '7': "rfc931", '8': "how", '9': "type"}
+LOCATION = "test"
+
+
+def make_lines(n: int, start: float, client_ip: str = "10.0.0.1") -> bytes:
+
+    return b"".join(f"{start + i:.3f}    120 {client_ip} TCP_MISS/200 1500 GET http://example.com/{i:06d} - "
+                    f"HIER_DIRECT/1.2.3.4 text/html\n".encode() for i in range(n))
+
+
+def count_entries(db_file: str) -> int:
+
+    return entry_store.get_connection(db_file).execute("SELECT COUNT(*) FROM entries WHERE location = ?",
+                                                (LOCATION,)).fetchone()[0]
+
+
+def count_rollups_before(db_file: str, cutoff: float) -> int:
+
+    return entry_store.get_connection(db_file).execute("SELECT COUNT(*) FROM rollups WHERE start + resolution <= ?",
+                                                       (cutoff,)).fetchone()[0]
+
+
+async def ingest(bucket: str, db_file: str, queries: int = 1, spill_dir: str = None):
+
+    storage = LocalStorageClient()
+    objects = {_['name'].split("/")[-1][:-4]: _ for _ in (await storage.list_objects(bucket))['items']}
+    await gather(*(main.ingest_storage_objects(bucket, storage, LOCATION, objects, int(time()) - 86400, LOG_FIELDS,
+                                               spill_dir, db_file) for _ in range(queries)))
+
+
+def setup_store(tmp_path) -> tuple:
+
+    bucket = str(tmp_path / "bucket")
+    makedirs(join(bucket, "logs"))
+    return bucket, str(tmp_path / "entries.db")
+
+
+def test_concurrent_ingests_store_appended_lines_once(tmp_path):
+
+    bucket, db_file = setup_store(tmp_path)
+    path = join(bucket, "logs", "proxy1.log")
+    start = time() - 3600
+    with open(path, "wb") as fp:
+        fp.write(make_lines(1000, start))
+    run(ingest(bucket, db_file))
+    assert count_entries(db_file) == 1000
+
+    with open(path, "ab") as fp:
+        fp.write(make_lines(500, start + 1000))
+    run(ingest(bucket, db_file, queries=4))
+    assert count_entries(db_file) == 1500
+
+
+def test_rewritten_object_is_ingested_again(tmp_path):
+
+    bucket, db_file = setup_store(tmp_path)
+    path = join(bucket, "logs", "proxy1.log")
+    start = time() - 3600
+    with open(path, "wb") as fp:
+        fp.write(make_lines(1000, start))
+    run(ingest(bucket, db_file))
+
+    # Same line lengths, so the byte before the old end offset is still a newline
+    with open(path, "wb") as fp:
+        fp.write(make_lines(1500, start + 0.5, client_ip="10.0.0.2"))
+    run(ingest(bucket, db_file))
+    assert entry_store.get_connection(db_file).execute(
+        "SELECT COUNT(*) FROM entries WHERE location = ? AND client_ip = ?", (LOCATION, "10.0.0.2")).fetchone()[0] \
+        == 1500
+
+
+def test_purge_runs_at_most_once_per_interval(tmp_path, monkeypatch):
+
+    bucket, db_file = setup_store(tmp_path)
+    monkeypatch.setattr(entry_store, "_last_purges", {})
+    path = join(bucket, "logs", "proxy1.log")
+    with open(path, "wb") as fp:
+        fp.write(make_lines(1000, time() - 3600))
+    run(ingest(bucket, db_file))
+    assert count_entries(db_file) == 1000
+
+    assert entry_store.purge_entries(retention=1800, db_file=db_file) == 0
+    cutoff = time() - 1800
+    assert count_rollups_before(db_file, cutoff) > 0
+    assert entry_store.purge_entries(retention=1800, interval=0, db_file=db_file) == 1000
+    assert count_entries(db_file) == 0
+    assert count_rollups_before(db_file, cutoff) == 0
+
+
+def test_large_object_is_ingested_in_chunks(tmp_path):
+
+    bucket, db_file = setup_store(tmp_path)
+    path = join(bucket, "logs", "proxy1.log")
+    data = make_lines(5000, time() - 7200)
+    with open(path, "wb") as fp:
+        fp.write(data + b"1234567890.000 120 10.0.0.1")  # ends with a partial line
+    chunks = list(main.parse_log_chunks(data, LOG_FIELDS, chunk_size=4096))
+    assert len(chunks) > 1
+    assert [row for rows in chunks for row in rows] == main.parse_log_rows(data, LOG_FIELDS)
+
+    run(ingest(bucket, db_file, spill_dir=str(tmp_path / "spill")))
+    assert count_entries(db_file) == 5000
+    assert entry_store.get_ingest_state(LOCATION, "proxy1", db_file)['end_offset'] == len(data)
+
+
+def test_exact_and_prefix_filters_use_an_index(tmp_path):
+
+    db_file = str(tmp_path / "entries.db")
+    connection = entry_store.get_connection(db_file)
+    for log_filter, index in (({'client_ip': "=10.0.0.1"}, "entries_by_client_ip"),
+                              ({'client_ip': "10.0.*"}, "entries_by_client_ip"),
+                              ({'status_code': "=TCP_MISS/200"}, "entries_by_status_code")):
+        statements = []
+        connection.set_trace_callback(statements.append)
+        list(entry_store.query_entries(LOCATION, ["proxy1", "proxy2"], (0, time()), log_filter, 100, db_file))
+        connection.set_trace_callback(None)
+        plan = connection.execute(f"EXPLAIN QUERY PLAN {statements[-1]}").fetchall()
+        assert any(index in _[3] for _ in plan)
@@ -0,0 +1,51 @@
+from datetime import datetime, timezone
+from os import makedirs
+import json
+import time
+import main
+
+
+def make_object(name: str, updated: float, size: int = 1000) -> dict:
+
+    return {'name': name, 'size': str(size),
+            'updated': datetime.fromtimestamp(updated, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")[:-4] + "Z"}
+
+
+def test_select_log_objects_reads_updated_as_utc(monkeypatch):
+
+    monkeypatch.setenv("TZ", "America/Los_Angeles")
+    time.tzset()
+    try:
+        now = int(time.time())
+        live = make_object("logs/web1.log", now)
+        # Rotated an hour ago, which read as local time would be hours after now
+        rotated = make_object("logs/web1.log.1.gz", now - 3600)
+        assert main.get_updated_timestamp(live) == now
+        current, overlapping = main.select_log_objects([rotated, live], (now - 1000, now))
+        assert current['web1'] is live
+        assert overlapping['web1'][0] is live
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_cursor_resumes_at_line_cut_off_by_end_of_object(tmp_path, monkeypatch):
+
+    makedirs(tmp_path / "bucket" / "logs")
+    (tmp_path / "settings.toml").write_text('PARSE_WORKERS = 1\n')
+    (tmp_path / "locations.toml").write_text(f'[test]\nbucket_name = "{tmp_path / "bucket"}"\nbucket_type = "local"\n'
+                                             f'file_path = "logs/"\n')
+    monkeypatch.setattr(main, "SETTINGS_FILE", str(tmp_path / "settings.toml"))
+    monkeypatch.setattr(main, "LOCATIONS_FILE", str(tmp_path / "locations.toml"))
+    now = time.time()
+    first, second = (f"{now - _:.3f}    120 10.0.0.1 TCP_MISS/200 1500 GET http://example.com/ - "
+                     f"HIER_DIRECT/1.2.3.4 text/html\n".encode() for _ in (60, 30))
+    path = tmp_path / "bucket" / "logs" / "proxy1.log"
+    path.write_bytes(first + second[:40])
+    _ = main.run_get_data({'location': "test", 'interval': "3600"})
+    assert len(_['entries']) == 1
+
+    with open(path, "ab") as fp:
+        fp.write(second[40:])
+    _ = main.run_get_data({'location': "test", 'interval': "3600", 'cursor': json.dumps(_['cursor'])})
+    assert len(_['entries']) == 1
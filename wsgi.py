@@ -1,8 +1,12 @@
 from random import randint
 from traceback import format_exc
-from asyncio import run
-from flask import Flask, request, jsonify, render_template, Response, session
-from main import get_settings, get_locations, get_data, get_client_ips, read_cache_file, write_cache_file
+from time import time
+import json
+from urllib.parse import urlencode
+from flask import Flask, request, jsonify, render_template, Response, session, stream_with_context
+from main import get_settings, get_locations, run_get_data, get_client_ips, get_status_codes
+from result_cache import ResultCache, get_result_key, TTL, MAX_BYTES, BUCKET_SIZE
+from metrics import render_metrics
 
 
 DEFAULTS = {
@@ -16,6 +20,19 @@ app.config['JSON_SORT_KEYS'] = False
 app.config['SESSION_COOKIE_SAMESITE'] = "Strict"
 app.secret_key = str(randint(0, 1000000))
 
+result_cache = ResultCache()
+
+
+def get_cached_data(env_vars: dict, settings: dict, histogram: bool = False) -> dict:
+
+    """
+    Return get_data() results for the query, sharing them between identical requests made within a few seconds
+    """
+    result_cache.ttl = int(settings.get('RESULT_CACHE_TTL', TTL))
+    result_cache.max_bytes = int(settings.get('RESULT_CACHE_MAX_BYTES', MAX_BYTES))
+    key = get_result_key(env_vars, int(settings.get('RESULT_CACHE_BUCKET', BUCKET_SIZE))) + (('histogram', histogram),)
+    return result_cache.get(key, lambda: run_get_data(env_vars, histogram=histogram))
+
 
 @app.route("/")
 @app.route("/index.html")
@@ -60,8 +77,7 @@ def _top():
             if server_group := values.get('server_group'):
                 client_ips = get_client_ips(location, server_group)
                 #print("Got client", len(client_ips), "IPs for", location, server_group)
-            _ = read_cache_file('status_codes')
-            status_codes = _.get(location, [])
+            status_codes = get_status_codes(location)
         return render_template(request.path, locations=locations, interval=values['interval'], location=location,
                                server_groups=server_groups, server_group=values['server_group'], client_ips=client_ips,
                                status_codes=status_codes, intervals=intervals, status_code=values['status_code'],
@@ -83,11 +99,34 @@ def _middle():
         _fields = {'-1': 'server_name'}
         _ = settings.get('LOG_FIELDS')
         _fields.update(_)
-        _data = run(get_data(request.args)) if 'location' in request.args else dict(entries=[])
-        _num_entries = len(_data['entries'])
-        return render_template(request.path, server_group=_server_group, data=_data,
-                               num_entries=_num_entries,
-                               fields=_fields, client_ip=_client_ip, env_vars=request.args)
+        _stream = request.args.get('stream', "") not in ("", "0", "false")
+        if 'location' not in request.args:
+            _data = dict(entries=[])
+        elif _stream:
+            _data = run_get_data(request.args, _stream)
+        else:
+            _data = get_cached_data(request.args, settings)
+        _num_shown = None if _stream else len(_data['entries'])
+        _num_entries = _data.get('total_entries')
+        if _num_entries is None and not _data.get('limit'):
+            _num_entries = _num_shown
+        _pages = {}
+        if _limit := _data.get('limit'):
+            # Links to the neighboring pages keep every other parameter as is
+            _args = request.args.to_dict()
+            if (_offset := _data.get('offset', 0)) > 0:
+                _args['offset'] = max(_offset - _limit, 0)
+                _pages['previous'] = f"{request.path}?{urlencode(_args)}"
+            if _num_shown is None or _num_shown >= _limit:
+                _args['offset'] = _offset + _limit
+                _pages['next'] = f"{request.path}?{urlencode(_args)}"
+        _context = dict(server_group=_server_group, data=_data, num_entries=_num_entries, num_shown=_num_shown,
+                        pages=_pages, fields=_fields, client_ip=_client_ip, env_vars=request.args)
+        if _stream:
+            # Send table rows as they're rendered, rather than building the whole page first
+            return Response(stream_with_context(app.jinja_env.get_template(request.path).generate(**_context)),
+                            content_type="text/html")
+        return render_template(request.path, **_context)
     except Exception as e:
         return Response(format_exc(), 500, content_type=DEFAULTS['content_type'])
 
@@ -102,18 +141,59 @@ def _bottom():
         return Response(format_exc(), 500, content_type=DEFAULTS['content_type'])
 
 
+def generate_ndjson(data: dict):
+
+    start = time()
+    for entry in data['entries']:
+        yield json.dumps(entry) + "\n"
+    summary = {k: v for k, v in data.items() if k != 'entries'}
+    if 'durations' in summary:
+        summary['durations']['stream'] = f"{round(time() - start, 3):.3f}"
+    yield json.dumps({'summary': summary}) + "\n"
+
+
 @app.route("/get_data")
 def _get_data():
 
     try:
         settings = get_settings()
         response_headers = settings.get('RESPONSE_HEADERS', DEFAULTS['response_headers'])
-        data = run(get_data(request.args)) if request.args.get('location') else dict(entries=[])
+        if request.args.get('format') == "ndjson":
+            # Stream one entry per line as they're merged, followed by everything else as a summary line
+            data = run_get_data(request.args, True) if request.args.get('location') else dict(entries=[])
+            return Response(stream_with_context(generate_ndjson(data)), content_type="application/x-ndjson",
+                            headers=response_headers)
+        data = get_cached_data(request.args, settings) if request.args.get('location') else dict(entries=[])
         return jsonify(data), response_headers
     except Exception as e:
         return Response(format_exc(), 500, content_type=DEFAULTS['content_type'])
 
 
+@app.route("/get_histogram")
+def _get_histogram():
+
+    try:
+        settings = get_settings()
+        response_headers = settings.get('RESPONSE_HEADERS', DEFAULTS['response_headers'])
+        data = get_cached_data(request.args, settings, True) if request.args.get('location') else {}
+        return jsonify(data), response_headers
+    except Exception as e:
+        return Response(format_exc(), 500, content_type=DEFAULTS['content_type'])
+
+
+@app.route("/metrics")
+def _metrics():
+
+    try:
+        gauges = {
+            'result_cache_entries': ("Results held by the result cache", len(result_cache.results)),
+            'result_cache_bytes': ("Approximate memory used by the result cache", result_cache.total_bytes),
+        }
+        return Response(render_metrics(gauges), content_type="text/plain; version=0.0.4")
+    except Exception as e:
+        return Response(format_exc(), 500, content_type=DEFAULTS['content_type'])
+
+
 if __name__ == '__main__':
 
     app.run(debug=True)